@@ -2,6 +2,8 @@ from . import errors
 from . import tokens
 from . import lexer
 from . import parser
+from . import cache
+from . import parallel
 
 
 __version__ = '0.0.0'
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""On-disk cache of lexers imported from rule files.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+from . import lexer
+
+
+class LexerCache:
+    """Cache of lexers imported from rule files.
+
+    Lexers are stored as JSON dumps of their state (see lexer.Lexer.dumps()) in files named after
+    SHA-256 hash of the rules, Tartak version and cache format, so changed rules or an upgrade of Tartak
+    never hit a stale entry.
+    Entries are written atomically; unreadable entries are treated as missing and are overwritten.
+
+    Cache directory is taken from the path given, TARTAK_CACHE_DIR environment variable, or
+    defaults to ~/.cache/tartak.
+    """
+    _FORMAT = 1
+
+    def __init__(self, path=None):
+        if path is None: path = os.environ.get('TARTAK_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'tartak'))
+        self._path = path
+
+    def path(self):
+        return self._path
+
+    def key(self, string):
+        """Returns key of the entry for given rules.
+        """
+        from . import __version__
+        return hashlib.sha256('{0}\0{1}\0{2}'.format(__version__, self._FORMAT, string).encode('utf-8')).hexdigest()
+
+    def _file(self, string):
+        return os.path.join(self._path, '{0}.json'.format(self.key(string)))
+
+    def get(self, string):
+        """Returns lexer cached for given rules, or None if there is no usable entry.
+        """
+        try:
+            with open(self._file(string), 'r') as ifstream: state = json.loads(ifstream.read())
+            return lexer.Lexer().loads(state)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def put(self, string, lxr):
+        """Stores lexer for given rules.
+        """
+        os.makedirs(self._path, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self._path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as ofstream: ofstream.write(json.dumps(lxr.dumps()))
+            os.replace(path, self._file(string))
+        except BaseException:
+            if os.path.exists(path): os.remove(path)
+            raise
+        return self
+
+    def lexer(self, string):
+        """Returns lexer for given rules.
+        On a miss rules are imported and the lexer is cached; failure to write the cache is not an error.
+        """
+        lxr = self.get(string)
+        if lxr is None:
+            lxr = lexer.Importer().feed(string).parse().lexer()
+            try: self.put(string, lxr)
+            except OSError: pass
+        return lxr
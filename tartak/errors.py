@@ -13,6 +13,10 @@ class EmptyRuleError(LexerError):
     pass
 
 
+class AmbiguousTokenError(LexerError):
+    pass
+
+
 class ParserError(TartakError):
     pass
 
@@ -23,3 +27,11 @@ class TartakSyntaxError(ParserError):
 
 class EndOfTokenStreamError(ParserError):
     pass
+
+
+class TokenFormatError(TartakError):
+    pass
+
+
+class LexerWarning(Warning):
+    pass
@@ -1,14 +1,111 @@
 #!/usr/bin/env python3
 
+import array
+import bisect
+import codecs
+import functools
+import inspect
+import itertools
+import mmap
 import re
 import warnings
 
-from .errors import LexerError, EmptyRuleError, ParserError, TartakSyntaxError
-from .tokens import Token, TokenStream
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+from .errors import LexerError, EmptyRuleError, AmbiguousTokenError, LexerWarning, ParserError, TartakSyntaxError
+from .tokens import Token, LazyToken, TokenStream, TokenColumns, SymbolTable, _bisect
 
 
 DEBUG = False
 
+
+# escape sequences decoded in strings, by value of 'escapes' flag
+_escapes = {
+    'basic': {'n': '\n', 't': '\t', 'r': '\r', '\\': '\\'},
+    'raw': {},
+}
+_escapes['full'] = dict(_escapes['basic'], **{'"': '"', "'": "'", 'a': '\a', 'b': '\b', 'f': '\f', 'v': '\v', '0': '\0', '\n': ''})
+_escape_sequence = re.compile(r'\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|.)', re.DOTALL)
+
+
+def decode(text, escapes='basic'):
+    """Decodes escape sequences in text in a single pass.
+    Escapes tell which sequences are decoded: 'basic' decodes \\n, \\t, \\r and \\\\, 'full' also decodes
+    quotes, \\a, \\b, \\f, \\v, \\0, escaped newlines, and \\xNN, \\uNNNN and \\UNNNNNNNN codes, and 'raw' decodes nothing.
+    Unknown sequences are left as they are.
+    """
+    if escapes == 'raw' or '\\' not in text: return text
+    table, codes = _escapes[escapes], (escapes == 'full')
+    def replace(match):
+        sequence = match.group(1)
+        if sequence in table: return table[sequence]
+        if codes and len(sequence) > 1 and int(sequence[1:], 16) <= 0x10ffff: return chr(int(sequence[1:], 16))
+        return match.group(0)
+    return _escape_sequence.sub(replace, text)
+
+
+def cook(t_group, t_type, text, escapes='basic'):
+    """Returns value of a token given its group, type and source text.
+    Strings lose their quotes and have escape sequences decoded (see decode()), other tokens are left as they are.
+    """
+    if t_group != 'string': return text
+    text = (text[1:-1] if t_type in ['double', 'single'] else text[3:-3])
+    return decode(text, escapes)
+
+
+def _firstchars(items):
+    """Returns set of characters matches of parsed regular expression can begin with (None if it
+    cannot be told), and whether the expression can match empty string.
+    """
+    chars = set()
+    for op, av in items:
+        op = str(op)
+        if op == 'LITERAL':
+            chars.add(chr(av))
+            return (chars, False)
+        elif op == 'IN':
+            for o, a in av:
+                if str(o) == 'LITERAL': chars.add(chr(a))
+                elif str(o) == 'RANGE' and a[1]-a[0] < 256: chars.update(chr(c) for c in range(a[0], a[1]+1))
+                else: return (None, False)
+            return (chars, False)
+        elif op in ('SUBPATTERN', 'ATOMIC_GROUP', 'BRANCH', 'MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT'):
+            if op == 'SUBPATTERN' and av[1] & re.IGNORECASE: return (None, False)
+            if op == 'SUBPATTERN': subs, nullable = [av[-1]], False
+            elif op == 'ATOMIC_GROUP': subs, nullable = [av], False
+            elif op == 'BRANCH': subs, nullable = av[1], False
+            else: subs, nullable = [av[2]], (av[0] == 0)
+            for sub in subs:
+                first, empty = _firstchars(sub)
+                if first is None: return (None, False)
+                chars |= first
+                nullable = nullable or empty
+            if not nullable: return (chars, False)
+        elif op == 'AT':
+            continue
+        else:
+            return (None, False)
+    return (chars, True)
+
+
+def _anchored(items):
+    """Returns True if parsed regular expression anchors a match at the beginning of the string (^ or \\A).
+    """
+    for op, av in items:
+        if str(op) == 'AT' and str(av) in ('AT_BEGINNING', 'AT_BEGINNING_STRING'): return True
+        for sub in (av if isinstance(av, (tuple, list)) else [av]):
+            for pattern in (sub if isinstance(sub, list) else [sub]):
+                if isinstance(pattern, sre_parse.SubPattern) and _anchored(pattern): return True
+    return False
+
+
+# characters at which scanning of strings must stop, by quote character
+_string_stops = {q: re.compile(r'[{0}\\\n]'.format(q)) for q in '"\''}
+
+
 # Rule-related abstarctions
 class LexerRule:
     """Rule object that encapsulates pattern of single token.
@@ -31,15 +128,27 @@ class LexerRule:
     def pattern(self):
         return self._pattern
 
-    def match(self, string):
+    def match(self, string, pos=0):
         """This method must be overridden in inheriting classes.
         Raise an exception if used directly.
 
-        This method takes input string as a parameter and returns matched part of that string,
-        or None if nothing was matched.
+        This method takes input string and an offset into it as parameters and returns part of the string
+        matched at that offset, or None if nothing was matched.
         """
         raise Exception('this method must be overridden')
 
+    def fragment(self):
+        """Returns source of a regular expression equivalent to this rule,
+        or None if the rule cannot be fused with other rules.
+        """
+        return None
+
+    def first(self):
+        """Returns set of characters tokens matched by this rule can begin with,
+        or None if it cannot be told.
+        """
+        return None
+
     def data(self):
         """Returns a dict containing rule's data.
         """
@@ -60,27 +169,287 @@ class StringRule(LexerRule):
         super(StringRule, self).__init__(*args, **kwargs)
         self._type = 'string'
 
-    def match(self, string):
-        match = (self._pattern if string.startswith(self._pattern) else None)
+    def match(self, string, pos=0):
+        match = (self._pattern if string.startswith(self._pattern, pos) else None)
         if match is not None and self._identifier_char.match(self._pattern) is not None:
-            n = len(string[len(match):])
-            if n > 0 and self._identifier_char.match(string[len(match)]) is not None: match = None
+            if self._identifier_char.match(string, pos+len(match)) is not None: match = None
         return match
 
+    def fragment(self):
+        fragment = re.escape(self._pattern)
+        if self._identifier_char.match(self._pattern) is not None: fragment += '(?![a-zA-Z0-9_])'
+        return fragment
+
+    def first(self):
+        return frozenset(self._pattern[0])
+
 
 class RegexRule(LexerRule):
     """Object designed to match regex rules.
     """
+    _unfusable = re.compile(r'\\[1-9]|\(\?P[=<]|\(\?\(')
     def __init__(self, *args, **kwargs):
         super(RegexRule, self).__init__(*args, **kwargs)
         pattern = kwargs['pattern']
-        self._regex = re.compile('^{0}'.format(pattern) if pattern[0] != '^' else pattern)
+        # matching is always anchored at the offset given to .match() so leading caret is redundant,
+        # and it must be removed because it would only match at the very beginning of the input
+        self._regex = re.compile(pattern[1:] if pattern[0] == '^' else pattern)
+        # other anchors at the beginning of the string must see the token as the start of the input,
+        # so such patterns are matched against the input sliced at the offset
+        self._sliced = _anchored(sre_parse.parse(self._regex.pattern, self._regex.flags))
+        if self._sliced: self._regex = re.compile(pattern)
         self._type = 'regex'
 
-    def match(self, string):
-        matched = self._regex.match(string)
+    def match(self, string, pos=0):
+        matched = (self._regex.match(string[pos:]) if self._sliced else self._regex.match(string, pos))
         return (matched.group() if matched is not None else None)
 
+    def fragment(self):
+        # backreferences, named groups and flags would change their meaning (or break) when
+        # the pattern is embedded in a bigger regular expression
+        if self._sliced or self._regex.flags != re.UNICODE or self._unfusable.search(self._regex.pattern) is not None: return None
+        return self._regex.pattern
+
+    def first(self):
+        if self._sliced or self._regex.flags & re.IGNORECASE: return None
+        parsed = sre_parse.parse(self._regex.pattern, self._regex.flags)
+        if parsed.state.flags & re.IGNORECASE: return None
+        chars, nullable = _firstchars(parsed)
+        return (frozenset(chars) if chars is not None and not nullable else None)
+
+
+class SlicingRule:
+    """Adapter of a rule whose .match() takes only the input string (without an offset).
+    The rule is given the input sliced at the offset.
+    """
+    def __init__(self, rule):
+        self._rule = rule
+
+    def group(self):
+        return self._rule.group()
+
+    def type(self):
+        return self._rule.type()
+
+    def match(self, string, pos=0):
+        return self._rule.match(string[pos:])
+
+
+def _takesOffset(rule):
+    """Returns True if .match() of given rule accepts an offset after the string.
+    """
+    if isinstance(rule, LexerRule): return True
+    try:
+        inspect.signature(rule.match).bind('', 0)
+    except TypeError:
+        return False
+    except ValueError:
+        pass
+    return True
+
+
+class StringTrie:
+    """String rules compiled into a trie, so the matching literal is found in one pass over the input.
+
+    Like with rules tried one by one, of the literals matched at an offset the one of the earliest
+    rule wins, and literals beginning with an identifier character only match if they are not
+    followed by one.
+    """
+    def __init__(self, rules):
+        self._rules = tuple(rules)
+        self._root = {}
+        for i, r in enumerate(self._rules):
+            node = self._root
+            for c in r.pattern(): node = node.setdefault(c, {})
+            node.setdefault(None, (i, r, StringRule._identifier_char.match(r.pattern()) is not None))
+
+    def rules(self):
+        """Returns rules this object was compiled from.
+        """
+        return self._rules
+
+    def match(self, string, pos=0):
+        """Returns group, type and text of the token matched at given offset.
+        Text is None if no rule matched.
+        """
+        node, end, best = self._root, pos, None
+        while end < len(string):
+            node = node.get(string[end])
+            if node is None: break
+            end += 1
+            terminal = node.get(None)
+            if terminal is None or (best is not None and best[0] < terminal[0]): continue
+            if not terminal[2] or StringRule._identifier_char.match(string, end) is None: best = (terminal[0], terminal[1], end)
+        if best is None: return (None, None, None)
+        return (best[1].group(), best[1].type(), string[pos:best[2]])
+
+
+class FusedRules:
+    """Lexer rules compiled into as few regular expressions as possible.
+
+    Runs of fusable rules are joined into a single alternation of named groups so
+    the regex engine picks the winning rule in one call.
+    Alternatives are tried in order, so the first matching rule wins just like with
+    rules tried one by one.
+    Rules that cannot be fused are matched on their own between fused runs.
+
+    Long runs of string rules are compiled into a StringTrie instead, as the cost of
+    an alternation grows with the number of literals it holds.
+    """
+    _trie_threshold = 32
+
+    def __init__(self, rules):
+        self._rules = tuple(rules)
+        self._steps = []
+        run = []
+        for is_string, rules in itertools.groupby(self._rules, key=lambda r: isinstance(r, StringRule)):
+            rules = list(rules)
+            if is_string and len(rules) >= self._trie_threshold:
+                self._fuse(run)
+                run = []
+                self._steps.append((None, StringTrie(rules)))
+                continue
+            for r in rules: run = self._add(run, r)
+        self._fuse(run)
+
+    def _add(self, run, r):
+        fragment = (r.fragment() if isinstance(r, LexerRule) else None)
+        if fragment is not None:
+            run.append((fragment, r))
+        else:
+            self._fuse(run)
+            run = []
+            self._steps.append((None, r))
+        return run
+
+    def _fuse(self, run):
+        if not run: return
+        names = {}
+        parts = []
+        for i, (fragment, r) in enumerate(run):
+            name = 'r{0}'.format(i)
+            names[name] = (r.group(), r.type())
+            parts.append('(?P<{0}>{1})'.format(name, fragment))
+        self._steps.append((re.compile('|'.join(parts)), names))
+
+    def rules(self):
+        """Returns rules this object was compiled from.
+        """
+        return self._rules
+
+    def match(self, string, pos=0):
+        """Returns group, type and text of the token matched at given offset.
+        Text is None if no rule matched.
+        """
+        for regex, target in self._steps:
+            if regex is not None:
+                matched = regex.match(string, pos)
+                if matched is not None:
+                    t_group, t_type = target[matched.lastgroup]
+                    return (t_group, t_type, matched.group())
+            elif isinstance(target, StringTrie):
+                t_group, t_type, token = target.match(string, pos)
+                if token is not None: return (t_group, t_type, token)
+            else:
+                token = target.match(string, pos)
+                if token is not None: return (target.group(), target.type(), token)
+        return (None, None, None)
+
+
+class DispatchedRules:
+    """Lexer rules dispatched on the first character of the input.
+
+    For every character only rules whose tokens can begin with it (see LexerRule.first()) are tried,
+    fused into FusedRules in their original order, so the first matching rule still wins;
+    rules for which the set of first characters is unknown are tried for every character.
+    Candidates are selected when a character is seen for the first time, and characters
+    with the same candidates share compiled rules.
+    """
+    def __init__(self, rules):
+        self._rules = tuple(rules)
+        self._first = [(r.first() if isinstance(r, LexerRule) else None) for r in self._rules]
+        self._table, self._fused = {}, {}
+
+    def rules(self):
+        """Returns rules this object was compiled from.
+        """
+        return self._rules
+
+    def _candidatesFor(self, c):
+        key = tuple(i for i, first in enumerate(self._first) if first is None or c in first)
+        fused = self._fused.get(key)
+        if fused is None: fused = self._fused[key] = FusedRules([self._rules[i] for i in key])
+        self._table[c] = fused
+        return fused
+
+    def match(self, string, pos=0):
+        """Returns group, type and text of the token matched at given offset.
+        Text is None if no rule matched.
+        """
+        if pos >= len(string): return (None, None, None)
+        fused = self._table.get(string[pos])
+        if fused is None: fused = self._candidatesFor(string[pos])
+        return fused.match(string, pos)
+
+
+class LongestMatch:
+    """Lexer rules arranged for finding the longest match at an offset (used in 'long' matching mode).
+
+    Literals of string rules are stored in a trie that is walked along the input, so only
+    literals which are prefixes of the input are checked.
+    Other rules are dispatched on the first character of the input using sets of characters their
+    tokens can begin with (see LexerRule.first()); rules for which the set is unknown are tried everywhere.
+    Of matches of the same length the one of the earliest rule wins.
+    """
+    def __init__(self, rules):
+        self._rules = tuple(rules)
+        self._trie, self._dispatch, self._any = {}, {}, []
+        for i, r in enumerate(self._rules):
+            if isinstance(r, StringRule):
+                node = self._trie
+                for c in r.pattern(): node = node.setdefault(c, {})
+                node.setdefault(None, (i, r))
+                continue
+            first = (r.first() if isinstance(r, LexerRule) else None)
+            if first is None:
+                self._any.append((i, r))
+            else:
+                for c in first: self._dispatch.setdefault(c, []).append((i, r))
+        self._candidates = {}
+
+    def rules(self):
+        """Returns rules this object was compiled from.
+        """
+        return self._rules
+
+    def _candidatesFor(self, c):
+        candidates = self._candidates.get(c)
+        if candidates is None:
+            candidates = self._candidates[c] = tuple(sorted(self._dispatch.get(c, []) + self._any, key=lambda candidate: candidate[0]))
+        return candidates
+
+    def match(self, string, pos=0):
+        """Returns group, type and text of the longest token matched at given offset.
+        Text is None if no rule matched.
+        """
+        if pos >= len(string): return (None, None, None)
+        token, index, rule = None, None, None
+        node, end = self._trie, pos
+        while end < len(string):
+            node = node.get(string[end])
+            if node is None: break
+            end += 1
+            terminal = node.get(None)
+            if terminal is not None and terminal[1].match(string, pos) is not None:
+                token, (index, rule) = string[pos:end], terminal
+        for i, r in self._candidatesFor(string[pos]):
+            matched = r.match(string, pos)
+            if matched is None: continue
+            if token is None or len(matched) > len(token) or (len(matched) == len(token) and i < index):
+                token, index, rule = matched, i, r
+        if token is None: return (None, None, None)
+        return (rule.group(), rule.type(), token)
+
 
 # Exporting and importing lexer files (*.lexer)
 class Exporter:
@@ -134,7 +503,7 @@ class Importer:
     def parse(self):
         """Parses tokens into rules.
         """
-        from .parser import Parser
+        from .parser import Parser, Memo
         self._makelex()
         parser = Parser(self._lexer)
         rule_token = [
@@ -231,23 +600,21 @@ class Importer:
                 ]
             }
         ]
-        orig = self._lexer.feed(self._string).tokenize().tokens().remove(group='comment')
-        tokens = orig.copy()
+        tokens = self._lexer.feed(self._string).tokenize().tokens().remove(group='comment')
         matches = []
+        memo = Memo()
         i = 0
-        while tokens:
-            match, count = Parser.matchrule(rule_flag, tokens)
+        while i < len(tokens):
+            match, end = Parser.matchat(rule_flag, tokens, i, memo)
             if not match:
-                match, count = Parser.matchrule(rule_token, tokens)
+                match, end = Parser.matchat(rule_token, tokens, i, memo)
             if match:
-                matched = tokens.slice(0, count)
-                i += count
-                tokens = tokens.slice(count)
-                matches.append(matched)
+                matches.append(tokens.slice(i, end))
+                i = end
             else:
-                line, char = orig.get(i+count-1).line(), orig.get(i+count-1).char()
+                line, char = tokens.get(end-1).line(), tokens.get(end-1).char()
                 msg =  'syntax error on line {0}, character {1}: '.format(line, char)
-                msg += 'unexpected token type: "{0}:{1}"\n\n'.format(orig.get(i+count-1).group(), orig.get(i+count-1).type())
+                msg += 'unexpected token type: "{0}:{1}"\n\n'.format(tokens.get(end-1).group(), tokens.get(end-1).type())
                 msg += '{0}\n'.format(self._lexer.getline(line, rebuild=True).rstrip())
                 msg += '{0}^'.format('-'*char)
                 raise TartakSyntaxError(msg)
@@ -286,10 +653,14 @@ class Importer:
 class Lexer:
     """Lexer class.
     """
+    _modes = ('simple', 'long', 'inspect', 'debug')
+
     def __init__(self, string=''):
         self._rules = []
         self._line, self._char = 0, 0
-        self._tokens, self._raw = TokenStream.new(2)
+        self._lines, self._linesShift, self._base = array.array('q', [0]), (0, 0), 0
+        self._symbols = SymbolTable()
+        self._tokens, self._raw = TokenStream(), TokenStream(columns=TokenColumns(string, self._symbols))
         self._string = string
         self._flags = {
             'string-single': True,
@@ -297,7 +668,12 @@ class Lexer:
             'string-dbl-triple': False,
             'string-sgl-triple': False,
             'newline': '\n',
+            'compact': False,
+            'escapes': 'basic',
         }
+        self._compiled, self._matched, self._fused, self._longest, self._quotes, self._spaces, self._starts = None, [], None, None, [], None, None
+        self._invalid, self._options, self._unclosed, self._edited, self._resume = (0, 0), None, [], None, None
+        self._cook = cook
 
     def __iter__(self):
         return iter(self._tokens)
@@ -313,174 +689,487 @@ class Lexer:
 
     def append(self, rule):
         """Append rule to the list of rules.
-        Accepts any object that has .match(str) method.
+        Accepts any object that has .match(str, pos) or .match(str) method (the latter is given
+        the input sliced at the offset, see SlicingRule).
         """
         try:
-            rule.match('')
+            if _takesOffset(rule): rule.match('', 0)
+            else: rule.match('')
         except:
             raise TypeError('{0} cannot be used as a rule'.format(type(rule)))
         self._rules.append(rule)
+        if isinstance(rule, LexerRule): self._symbols.code(rule.group(), rule.type())
+        self._compiled = None
         return self
 
     def setFlag(self, flag, value=True):
         """Sets flag to specified value.
         """
         self._flags[flag] = value
+        self._compiled = None
         return self
 
+    def compile(self):
+        """Compiles rules and flags into the form used during tokenization.
+        Tokenization compiles the lexer automatically; the compiled form is rebuilt whenever
+        rules or flags change (even if they were modified directly).
+        """
+        signature = (tuple(map(id, self._rules)), sorted(self._flags.items()))
+        if self._compiled == signature: return self
+        escapes = self._flags.get('escapes', 'basic')
+        if escapes not in _escapes: raise ValueError('unknown escapes mode: {0}'.format(escapes))
+        self._cook = functools.partial(cook, escapes=escapes)
+        self._matched = [(r if _takesOffset(r) else SlicingRule(r)) for r in self._rules]
+        self._fused, self._longest = DispatchedRules(self._matched), None
+        self._quotes = [(quote, name[-6:]) for quote, name in [('"""', 'string-dbl-triple'), ("'''", 'string-sgl-triple'), ('"', 'string-double'), ("'", 'string-single')] if self._flags[name]]
+        newline = self._flags['newline']
+        if len(newline) == 1: self._spaces = re.compile('[^\\S{0}]+'.format(re.escape(newline)))
+        else: self._spaces = re.compile('(?:(?!{0})\\s)+'.format(re.escape(newline)))
+        self._starts = self._compileStarts()
+        self._compiled = signature
+        return self
+
+    def _compileStarts(self):
+        """Returns regular expression matching wherever a token may begin, or None if it cannot be built.
+        Whitespace, quotes and first characters of rules are matched as a character class; rules
+        whose first characters are unknown are matched with their own patterns.
+        """
+        chars, fragments = set(quote[0] for quote, t_type in self._quotes), []
+        for r in self._rules:
+            first = (r.first() if isinstance(r, LexerRule) else None)
+            if first is not None:
+                chars.update(first)
+                continue
+            fragment = (r.fragment() if isinstance(r, LexerRule) else None)
+            if fragment is None: return None
+            fragments.append('(?:{0})'.format(fragment))
+        return re.compile('|'.join(['[\\s{0}]'.format(''.join(re.escape(c) for c in sorted(chars)))] + fragments))
+
     def rules(self):
         """Returns lexer's list of rules.
         """
         return self._rules
 
-    def _matchWhitespace(self, string):
-        return (string and string[0].strip() == '')
-
-    def _consumeWhitespace(self, string, indent=False):
-        """Conusme whitespace and return trimmed string.
-        """
-        token, t_type, t_group = None, None, None
-        while string and string[0].strip() == '':
-            if string.startswith(self._flags['newline']):
-                if token is not None:
-                    self._raw.append(Token(self._line, self._char, token, t_type, t_group))
-                    if indent: self._tokens.append(Token(self._line, self._char, token, t_type, t_group))
-                token, t_type, t_group = self._flags['newline'], 'newline', 'whitespace'
-                string = string[len(self._flags['newline']):]
-                self._raw.append(Token(self._line, self._char, token, t_type, t_group))
-                token, t_type, t_group = None, None, None
-                self._line += len(self._flags['newline'])
-                self._char = 0
-            elif string[0] == '\t':
-                t_type, t_group = 'tab', 'whitespace'
-                if token is None: token = string[0]
-                else: token += string[0]
-                string = string[1:]
-                self._char += 1
-            else:
-                t_type, t_group = 'space', 'whitespace'
-                if token is None: token = string[0]
-                else: token += string[0]
-                string = string[1:]
-                self._char += 1
-        if token is not None:
-            self._raw.append(Token(self._line, self._char-1, token, t_type, t_group))
-            if self._char - len(token) == 0 and indent: self._tokens.append(Token(self._line, self._char-1, token, t_type, t_group))
-        return string
-
-    def _matchString(self, s, quote):
-        """Method that will match strings.
+    def symbols(self):
+        """Returns symbol table holding codes of groups and types of lexer's tokens.
+        Codes are assigned to groups and types of rules when rules are appended.
         """
-        match = None
-        n = len(quote)
-        original = s[:]
-        if s.startswith(quote):
-            match = quote
-            s = s[n:]
-        else:
-            return match
-        closed = False
-        for i, char in enumerate(s):
-            if s[i:].startswith(quote):
-                backs = 1
-                while backs < len(s) and match[-backs].endswith('\\'): backs += 1
-                if (backs-1) % 2 == 0:
-                    match += quote
-                    closed = True
-                    break
-            if char == '\n' and quote not in ['"""', "'''"]:
-                line = self._string.splitlines()[self._line]
-                report =  'broken string on line {0}, character {1}:\n'.format(self._line+1, self._char+1)
-                report += line + '\n'
-                report += '{0}^'.format('-'*(self._char+(len(match) if match is not None else 1)))
-                raise LexerError(report)
-            if char == '\n' and  quote in ['"""', "'''"]:
+        return self._symbols
+
+    def invalid(self):
+        """Returns number and total length of invalid sequences saved or dropped during last tokenization.
+        """
+        return self._invalid
+
+    def edited(self):
+        """Returns (first, last, count) tuple telling that cooked tokens between indexes first and last
+        were replaced with count tokens during last .relex(), or None if lexer was not relexed.
+        """
+        return self._edited
+
+    def _matchWhitespace(self, string, pos=0):
+        return (pos < len(string) and string[pos].isspace())
+
+    def _consumeWhitespace(self, string, pos, stop, indent=False):
+        """Consume whitespace starting at given offset and generate tokens for it (see ._scan()).
+        Leaves the offset of first non-whitespace character in self._pos.
+
+        Runs of whitespace between newlines are matched in one go; a run takes its type from its last character.
+        """
+        newline, spaces, t_group = self._flags['newline'], self._spaces, 'whitespace'
+        while pos < stop:
+            run = spaces.match(string, pos, stop)
+            if run is not None:
+                start, pos = run.span()
+                t_type = ('tab' if string[pos-1] == '\t' else 'space')
+                self._char += pos-start
+            if pos < stop and string[pos].isspace() and string.startswith(newline, pos):
+                if run is not None:
+                    yield (self._line, self._char, start, pos, t_type, t_group, indent)
+                yield (self._line, self._char, pos, pos+len(newline), 'newline', t_group, False)
+                pos += len(newline)
+                self._lines.append(self._base+pos)
                 self._line += 1
                 self._char = 0
-            match += char
-        match = (match if closed else None)
-        return match
+                continue
+            if run is not None:
+                yield (self._line, self._char-1, start, pos, t_type, t_group, (self._char - (pos-start) == 0 and indent))
+            break
+        self._pos = pos
 
-    def _matchAnyString(self, s):
-        match = False
-        for str_type_start, str_type_name in [('"""', 'string-dbl-triple'), ("'''", 'string-sgl-triple'), ('"', 'string-double'), ("'", 'string-single')]:
-            if s.startswith(str_type_start) and self._flags[str_type_name]:
-                if self._matchString(s, str_type_start) is not None:
-                    match = True
-                    break
-        return match
+    def _matchString(self, s, pos, quote):
+        """Method that will match strings.
+        Returns a tuple containing offset of the end of the string and number of newlines inside it,
+        or None if the string is not closed.
 
-    def _consumeString(self, s):
-        token, t_type, t_group = None, None, None
-        for str_type_start, str_type_name in [('"""', 'string-dbl-triple'), ("'''", 'string-sgl-triple'), ('"', 'string-double'), ("'", 'string-single')]:
-            if s.startswith(str_type_start) and self._flags[str_type_name]:
-                token, t_group, t_type = self._matchString(s, str_type_start), 'string', str_type_name[-6:]
-                break
-        return (t_group, t_type, token)
+        The scanner jumps between quote characters, backslashes and newlines; a backslash escapes
+        the character following it, so a quote closes the string if it is preceded by an even number of backslashes.
+        Offset and number of newlines at which the scan of a string that was not closed stopped are kept
+        in self._resume, so when more input is added (see .iter_tokens()) the scan goes on from there.
+        """
+        if not s.startswith(quote, pos): return None
+        n = len(quote)
+        triple = quote in ['"""', "'''"]
+        stops = _string_stops[quote[0]]
+        i, newlines = pos + n, 0
+        if self._resume is not None and self._resume[:2] == (self._base+pos, quote): i, newlines = self._resume[2]-self._base, self._resume[3]
+        while True:
+            stop = stops.search(s, i)
+            if stop is None:
+                self._resume = (self._base+pos, quote, self._base+len(s), newlines)
+                return None
+            i = stop.start()
+            if (s[i] == '\\' and i+1 == len(s)) or (s[i] == quote[0] and i+n > len(s)):
+                self._resume = (self._base+pos, quote, self._base+i, newlines)
+                return None
+            if s[i] == '\\':
+                i += 1
+                if i < len(s) and s[i] != '\n': i += 1
+                continue
+            if s[i] == '\n':
+                if not triple:
+                    line = self._linetext(s, i)
+                    report =  'broken string on line {0}, character {1}:\n'.format(self._line+1, self._char+1)
+                    report += line + '\n'
+                    report += '{0}^'.format('-'*(self._char+(i-pos)))
+                    raise LexerError(report)
+                newlines += 1
+            elif s.startswith(quote, i):
+                return (i+n, newlines)
+            i += 1
 
-    def _matchRule(self, s):
-        match = False
-        for r in self._rules:
-            if r.match(s) is not None:
-                match = True
+    def _consumeString(self, s, pos):
+        """Returns group and type of a string starting at given offset, and
+        a tuple with end offset and number of newlines in the string (None if no string was found).
+        Offsets of strings found not to be closed are kept in self._unclosed, as text added after them
+        may close them (see .relex()).
+        """
+        matched, t_type, t_group = None, None, None
+        for str_type_start, str_type in self._quotes:
+            if s.startswith(str_type_start, pos):
+                matched, t_group, t_type = self._matchString(s, pos, str_type_start), 'string', str_type
+                if matched is None and (not self._unclosed or self._unclosed[-1] < self._base+pos): self._unclosed.append(self._base+pos)
                 break
-        return match
+        return (t_group, t_type, matched)
 
-    def _consumeRule(self, s):
-        t_group, t_type, token = None, None, None
-        for r in self._rules:
-            token = r.match(s)
-            if token is not None:
-                t_type = r.type()
-                t_group = r.group()
-                break
+    def _matchRule(self, s, pos=0):
+        return (self._fused.match(s, pos)[2] is not None)
+
+    def _consumeRule(self, s, pos, mode='simple'):
+        """Returns group, type and text of the token matched at given offset using given matching mode
+        (see .tokenize()).
+        """
+        if mode == 'simple': return self._fused.match(s, pos)
+        if self._longest is None: self._longest = LongestMatch(self._matched)
+        if mode == 'long': return self._longest.match(s, pos)
+        t_group, t_type, token = self._fused.match(s, pos)
+        l_group, l_type, longest = self._longest.match(s, pos)
+        if token is not None and len(longest) > len(token):
+            report =  'ambiguous token at line {0}, character {1}: '.format(self._line+1, self._char+1)
+            report += '{0}:{1} matches {2} but {3}:{4} matches {5}\n'.format(t_group, t_type, repr(token), l_group, l_type, repr(longest))
+            report += self._linetext(s, pos) + '\n'
+            report += '{0}^'.format('-'*self._char)
+            if mode == 'debug': raise AmbiguousTokenError(report)
+            warnings.warn(report, LexerWarning)
         return (t_group, t_type, token)
 
-    def _consumeInvalid(self, s, errors='throw'):
-        t_group, t_type, token = None, None, None
-        invalid = ''
-        while (not self._matchRule(s) and not self._matchWhitespace(s) and not self._matchAnyString(s) and s):
-            invalid += s[0]
-            s = s[1:]
-        if token is None:
-            if errors == 'save':
-                t_group, t_type, token = 'tartak', 'invalid', invalid
-            elif errors == 'drop':
-                t_group, t_type, token = 'tartak', 'drop', invalid
+    def _resync(self, s, pos, final=True):
+        """Returns offset of the first position at or after given one at which a token can begin.
+        Candidate positions are found by searching for possible starts of tokens (see ._compileStarts())
+        and only they are checked against rules, whitespace and strings.
+        Unless final is True, None is returned when a string not closed before the end of s is found,
+        as more input may close it (and so decide where the sequence ends).
+        """
+        starts = self._starts
+        while pos < len(s):
+            if starts is not None:
+                found = starts.search(s, pos)
+                if found is None: break
+                pos = found.start()
+            if self._matchWhitespace(s, pos) or self._matchRule(s, pos): return pos
+            t_group, t_type, matched = self._consumeString(s, pos)
+            if matched is not None: return pos
+            if t_group is not None and not final: return None
+            pos += 1
+        return len(s)
+
+    def _consumeInvalid(self, s, pos, errors='throw', final=True):
+        """Returns group, type and text of invalid sequence starting at given offset.
+        The sequence extends up to the next position at which a token can begin; unless final is True,
+        None is returned as the text if more input is needed to tell where it is (see ._resync()).
+        """
+        if errors not in ('save', 'drop'):
+            line = self._linetext(s, pos)
+            report =  'cannot tokenize sequence starting at line {0}, character {1}:\n'.format(self._line+1, self._char+1)
+            report += line + '\n'
+            report += '{0}^'.format('-'*self._char)
+            raise LexerError(report)
+        end = self._resync(s, pos+1, final)
+        if end is None: return (None, None, None)
+        self._invalid = (self._invalid[0]+1, self._invalid[1]+(end-pos))
+        return ('tartak', ('invalid' if errors == 'save' else 'drop'), s[pos:end])
+
+    def _linetext(self, s, pos):
+        """Returns text of the line of s containing given offset.
+        Start of the line is looked up in the index of lines lexed so far.
+        """
+        start = max(self._lineAt(self._base+pos)[1] - self._base, 0)
+        end = s.find('\n', pos)
+        return s[start:(end if end > -1 else len(s))].rstrip('\r')
+
+    def _scan(self, string, pos, stop, final=True, indent=False, errors='throw', mode='simple'):
+        """Generates tokens found in string between pos and stop.
+        Tokens are generated as (line, char, start, end, type, group, cooked) tuples, where start and end
+        are offsets of token's text in the string, and cooked tells whether the token belongs
+        to cooked token stream or is raw-only (whitespace).
+        The string is never sliced; lexer walks it with an integer cursor instead, and
+        leaves the offset at which it stopped in self._pos.
+
+        Unless final is True, stop must point just past a newline and scanning ends before
+        any token that could continue past the available input (unclosed strings and
+        rules matching past the stop offset) as more input is needed to tell where it ends.
+        """
+        if mode not in self._modes: raise ValueError('unknown matching mode: {0}'.format(mode))
+        self._pos = pos
+        while pos < stop:
+            if string[pos].isspace():
+                yield from self._consumeWhitespace(string, pos, stop, indent)
+                pos = self._pos
+                if pos >= stop: break
+            t_group, t_type, matched = self._consumeString(string, pos)
+            if matched is not None:
+                end, newlines = matched
             else:
-                line = self._string.splitlines()[self._line]
-                report =  'cannot tokenize sequence starting at line {0}, character {1}:\n'.format(self._line+1, self._char+1)
-                report += line + '\n'
-                report += '{0}^'.format('-'*self._char)
-                raise LexerError(report)
-        return (t_group, t_type, token)
+                if not final and t_group is not None: break
+                t_group, t_type, match = self._consumeRule(string, pos, mode)
+                if match is None: t_group, t_type, match = self._consumeInvalid(string, pos, errors, final)
+                if match is None: break
+                end, newlines = pos+len(match), 0
+                if end > stop and not final: break
+            if newlines:
+                i = string.find('\n', pos, end)
+                while i > -1:
+                    self._lines.append(self._base+i+1)
+                    i = string.find('\n', i+1, end)
+                self._line += newlines
+                self._char = 0
+            if t_group == 'tartak' and t_type == 'drop':
+                self._pos = pos = end
+                continue
+            yield (self._line, self._char, pos, end, t_type, t_group, True)
+            self._char += end-pos
+            self._pos = pos = end
+
+    def _cooked(self, line, char, text, t_type, t_group):
+        """Returns cooked token of given source text.
+        Escape sequences in strings are decoded only when value of the token is requested.
+        """
+        code = self._symbols.code(t_group, t_type)
+        if t_group == 'string': return LazyToken(line, char, text, t_type, t_group, self._cook, code)
+        return Token(line, char, text, t_type, t_group, code)
 
-    def tokenize(self, indent=False, errors='throw'):
+    def _store(self, string, tokens):
+        """Stores tokens generated by ._scan() in lexer's token streams.
+        Raw tokens are always stored as offsets into the string; cooked ones only if 'compact' flag is set.
+        """
+        if self._flags.get('compact') and not self._tokens and self._tokens.columns() is None:
+            self._tokens = TokenStream(columns=TokenColumns(string, self._symbols, self._cook))
+        cooked, raw = self._tokens.columns(), self._raw.columns()
+        if cooked is not None: cooked_base = cooked.feed(string)
+        raw_base = self._base = raw.feed(string)
+        for line, char, start, end, t_type, t_group, is_cooked in tokens:
+            raw.span(line, char, raw_base+start, raw_base+end, t_type, t_group)
+            if not is_cooked: continue
+            if cooked is not None:
+                cooked.span(line, char, cooked_base+start, cooked_base+end, t_type, t_group)
+            else:
+                self._tokens.append(self._cooked(line, char, string[start:end], t_type, t_group))
+
+    def tokenize(self, indent=False, errors='throw', mode='simple'):
         """Generate tokens from the string received.
+        Mode tells how rules are matched:
+
+        - 'simple':  first matching rule wins,
+        - 'long':    longest match wins (of matches of the same length the one of the earliest rule),
+        - 'inspect': first matching rule wins, but a LexerWarning is issued when a later rule gives longer match,
+        - 'debug':   like 'inspect', but AmbiguousTokenError is raised instead of the warning.
+
+        Raw tokens are stored column-wise as offsets into the string (see tokens.TokenColumns);
+        if 'compact' flag is set, cooked tokens are stored the same way.
         """
-        string = self._string[:]
-        while string:
-            string = self._consumeWhitespace(string, indent)
-            if not string: break
-            t_group, t_type, match = self._consumeString(string)
-            if match is None: t_group, t_type, match = self._consumeRule(string)
-            if match is None: t_group, t_type, match = self._consumeInvalid(string, errors)
-            string = string[len(match):]
-            if t_group == 'string':
-                token = match.replace('\\n', '\n').replace('\\\\', '\\').replace('\\t', '\t').replace('\\r', '\r')
+        self.compile()
+        self._invalid, self._options, self._unclosed, self._edited, self._resume = (0, 0), (indent, errors, mode), [], None, None
+        self._store(self._string, self._scan(self._string, 0, len(self._string), True, indent, errors, mode))
+        return self
+
+    def _chunks(self, source, size, encoding):
+        """Generates string chunks of the source given to .iter_tokens().
+        """
+        if isinstance(source, str):
+            yield source
+            return
+        if isinstance(source, (bytes, bytearray, mmap.mmap)):
+            chunks = (source[i:i+size] for i in range(0, len(source), size))
+        elif hasattr(source, 'read'):
+            chunks = iter(lambda: source.read(size), source.read(0))
+        else:
+            chunks = source
+        decoder = codecs.getincrementaldecoder(encoding)()
+        for chunk in chunks:
+            yield (chunk if isinstance(chunk, str) else decoder.decode(chunk))
+        yield decoder.decode(b'', True)
+
+    def iter_tokens(self, source, indent=False, errors='throw', raw=False, size=2**16, encoding='utf-8', mode='simple'):
+        """Lazily generate tokens from a string, a file object or an iterable of string chunks.
+        Tokens are not stored in the lexer so memory use does not grow with the size of input.
+        If raw is True, raw tokens (including whitespace) are generated instead of cooked ones.
+        Mode is the matching mode (see .tokenize()).
+
+        Bytes-like sources (bytes, mmap objects, files opened in binary mode, and iterables of bytes)
+        are decoded incrementally using given encoding, so memory-mapped files can be lexed
+        without reading them whole.
+
+        Input is tokenized one complete line at a time, so tokens straddling chunk boundaries
+        are matched as if input was given in one piece; rules are assumed not to match across
+        newlines (strings, including triple-quoted ones, can).
+        """
+        chunks = self._chunks(source, size, encoding)
+        self.compile()
+        self._line, self._char = 0, 0
+        self._lines, self._linesShift, self._base = array.array('q', [0]), (0, 0), 0
+        self._invalid, self._unclosed, self._resume = (0, 0), [], None
+        newline = self._flags['newline']
+        buffer, pos = '', 0
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is None:
+                stop, final = len(buffer), True
             else:
-                token = match
-            if t_group == 'string':
-                if t_type in ['double', 'single']:
-                    token = token[1:-1]
-                else:
-                    token = token[3:-3]
-            if t_group == 'tartak' and t_type == 'drop': continue
-            self._tokens.append(Token(self._line, self._char, token, t_type, t_group))
-            self._raw.append(Token(self._line, self._char, match, t_type, t_group))
-            self._char += len(match)
+                cut = buffer.rfind('\n', 0, pos) + 1 # keep current line for error reports
+                buffer, pos = buffer[cut:] + chunk, pos-cut
+                self._base += cut
+                stop, final = buffer.rfind(newline), False
+                if stop < 0: continue
+                stop += len(newline)
+            for line, char, start, end, t_type, t_group, cooked in self._scan(buffer, pos, stop, final, indent, errors, mode):
+                if raw: yield Token(line, char, buffer[start:end], t_type, t_group, self._symbols.code(t_group, t_type))
+                elif cooked: yield self._cooked(line, char, buffer[start:end], t_type, t_group)
+            pos = self._pos
+
+    def _invalidIn(self, raw, first, last, pos, stop):
+        """Returns number and total length of invalid sequences among raw tokens in given range of indexes,
+        which begin at offset pos and end at offset stop.
+        Dropped sequences are found as gaps between the tokens.
+        """
+        count, size = 0, 0
+        codes, invalid = raw.codes(), self._symbols.code('tartak', 'invalid')
+        for i in range(first, last):
+            start, end = raw.offsets(i)
+            if start > pos: count, size = count+1, size+(start-pos)
+            if codes[i] == invalid: count, size = count+1, size+(end-start)
+            pos = end
+        if stop > pos: count, size = count+1, size+(stop-pos)
+        return (count, size)
+
+    def relex(self, start, end, text):
+        """Replaces text between given offsets of the string with given text, and updates tokens.
+        Lexer must have been tokenized with .tokenize(); the same indent, errors and mode are used.
+
+        Lexing restarts at the beginning of the line the edit begins in (or of an earlier line holding a string
+        that was not closed, as the edit may close it), and stops at the first newline after the edit at which
+        the new tokens line up with the old ones.
+        Tokens following it are reused with their lines and offsets shifted; the shift is not applied to them
+        until they are read (see tokens.TokenColumns.splice()), and the same is done for offsets of lines.
+        If lexing fails, the lexer is left as it was.
+        """
+        raw = self._raw.columns()
+        if self._options is None or raw.source() is not self._string: raise ValueError('lexer must be tokenized before relexing')
+        indent, errors, mode = self._options
+        self.compile()
+        string, offset = self._string[:start] + text + self._string[end:], len(text)-(end-start)
+        codes, newline = raw.codes(), self._symbols.code('whitespace', 'newline')
+        first = raw.bisect('end', (min(start, self._unclosed[0]) if self._unclosed else start), right=True)
+        while first and codes[first-1] != newline: first -= 1
+        pos, line = ((raw.offsets(first-1)[1], raw.line(first-1)+1) if first else (0, 0))
+        self._settleLines(_bisect(self._lines, pos, *self._linesShift, right=True))
+        state = (self._line, self._char, self._pos, self._lines, self._linesShift, self._invalid, self._unclosed)
+        self._line, self._char, self._invalid, self._unclosed, self._resume = line, 0, (0, 0), [], None
+        self._lines, self._linesShift = self._lines[:self._linesShift[0]], (0, 0)
+        tokens, last, synced = [], len(raw), False
+        try:
+            for token in self._scan(string, pos, len(string), True, indent, errors, mode):
+                tokens.append(token)
+                if token[4] != 'newline' or token[5] != 'whitespace' or token[2] < start+len(text): continue
+                i = raw.bisect('end', token[3]-offset)
+                if i < len(raw) and codes[i] == newline and raw.offsets(i)[1] == token[3]-offset:
+                    last, synced = i+1, True
+                    break
+        except LexerError:
+            self._line, self._char, self._pos, self._lines, self._linesShift, self._invalid, self._unclosed = state
+            raise
+        stop = (raw.offsets(last-1)[1] if synced else len(self._string))
+        old = self._invalidIn(raw, first, last, pos, stop)
+        self._invalid = (state[5][0]-old[0]+self._invalid[0], state[5][1]-old[1]+self._invalid[1])
+        lines = 0
+        if synced:
+            lines = tokens[-1][0] - raw.line(last-1)
+            self._line, self._char, self._pos = state[0]+lines, state[1], state[2]+offset
+            self._unclosed.extend(i+offset for i in state[6][bisect.bisect_left(state[6], stop):])
+            head, self._lines, self._linesShift = self._lines, state[3], state[4]
+            self._settleLines(_bisect(self._lines, stop, *self._linesShift))
+            at, moved = self._linesShift
+            self._lines, self._linesShift = head, (len(head), moved+offset)
+            head.extend(state[3][at:])
+        cooked = self._tokens.columns()
+        c_first = self._lineIndex(line)
+        c_last = (self._lineIndex(raw.line(last-1)+1) if synced else len(self._tokens))
+        spliced_raw = TokenColumns(string, self._symbols)
+        spliced = (TokenColumns(string, self._symbols, self._cook) if cooked is not None else [])
+        for t_line, t_char, t_start, t_end, t_type, t_group, is_cooked in tokens:
+            spliced_raw.span(t_line, t_char, t_start, t_end, t_type, t_group)
+            if not is_cooked: continue
+            if cooked is not None: spliced.span(t_line, t_char, t_start, t_end, t_type, t_group)
+            else: spliced.append(self._cooked(t_line, t_char, string[t_start:t_end], t_type, t_group))
+        self._tokens.splice(c_first, c_last, spliced, lines, offset, string)
+        self._raw.splice(first, last, spliced_raw, lines, offset, string)
+        self._string, self._edited = string, (c_first, c_last, len(spliced))
         return self
 
+    def _lineIndex(self, line):
+        """Returns index of the first cooked token on given line or after it.
+        """
+        cooked = self._tokens.columns()
+        if cooked is not None: return cooked.bisect('line', line)
+        low, high = 0, len(self._tokens)
+        while low < high:
+            middle = (low+high) // 2
+            if self._tokens.line(middle) < line: low = middle+1
+            else: high = middle
+        return low
+
+    def _settleLines(self, index):
+        """Moves the start of the pending shift of offsets of lines (see .relex()) to given index,
+        applying the shift to offsets it passes over or taking it back from them.
+        """
+        at, offset = self._linesShift
+        if offset:
+            sign = (1 if index > at else -1)
+            for i in range(min(at, index), max(at, index)): self._lines[i] += sign*offset
+        self._linesShift = ((index, offset) if index < len(self._lines) else (index, 0))
+
+    def _lineAt(self, offset):
+        """Returns number and starting offset of the line containing given offset.
+        """
+        at, shift = self._linesShift
+        line = _bisect(self._lines, offset, at, shift, right=True) - 1
+        return (line, self._lines[line] + (shift if line >= at else 0))
+
+    def position(self, offset):
+        """Returns (line, char) pair for given offset into lexed input.
+        Both numbers are counted from 0; offsets past the last lexed line are reported on that line.
+        """
+        line, start = self._lineAt(offset)
+        return (line, offset - start)
+
     def tokens(self, raw=False):
         """Return generated tokens.
         """
@@ -490,15 +1179,13 @@ class Lexer:
         """If rebuild is True, return string containing given line number.
         Else, return tokens found in this line.
         """
-        toks = []
-        if self._raw[-1].line() < n: return IndexError('line number too high: {0}'.format(n))
-        for t in self._raw:
-            if t.line() > n: break
-            if t.line() == n: toks.append(t)
+        raw = self._raw.columns()
+        if raw.line(-1) < n: return IndexError('line number too high: {0}'.format(n))
+        start, end = raw.bisect('line', n), raw.bisect('line', n, right=True)
         if rebuild:
-            line = ''.join([t.value() for t in toks])
+            line = raw.text(start, end)
         else:
-            line = toks
+            line = raw[start:end]
         return line
 
     def dumps(self):
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""Parallel lexing of large inputs.
+"""
+
+import array
+import bisect
+import concurrent.futures
+import itertools
+import re
+
+from . import lexer
+from .errors import LexerError
+
+
+# lexer of a worker process (see _initWorker())
+_worker = None
+
+
+def _initWorker(state):
+    global _worker
+    _worker = lexer.Lexer().loads(state).compile()
+
+
+def _lexChunk(text, final, indent, errors, mode):
+    """Lexes a chunk of input in a worker process.
+    Returns tokens generated by Lexer._scan() for the chunk, offset at which lexing stopped, number of lines and
+    character the lexer stopped at, offsets of lines begun in the chunk, number and length of invalid sequences,
+    and offsets of strings that were not closed.
+    Returns None if the chunk must be lexed again in the main process: when lexing failed, or when it stopped
+    before the end of the chunk after an invalid sequence (which may then have ended too early).
+    """
+    lxr = _worker
+    lxr._line, lxr._char = 0, 0
+    lxr._lines, lxr._linesShift, lxr._base, lxr._invalid, lxr._unclosed, lxr._resume = array.array('q', [0]), (0, 0), 0, (0, 0), [], None
+    try:
+        tokens = list(lxr._scan(text, 0, len(text), final, indent, errors, mode))
+    except LexerError:
+        return None
+    if lxr._pos < len(text) and lxr._invalid[0]: return None
+    return (tokens, lxr._pos, lxr._line, lxr._char, lxr._lines[1:], lxr._invalid, lxr._unclosed)
+
+
+def splits(string, size, newline='\n', quotes=()):
+    """Returns list of (start, end) offsets of chunks of string of about given size.
+    Every chunk but the last ends just past a newline.
+    Newlines inside triple-quoted strings (delimited by given quotes, as found by a quick scan
+    that knows nothing about other tokens) are avoided.
+    """
+    starts, ends = [], []
+    if quotes:
+        opened = None
+        for found in re.finditer('\\\\.|{0}'.format('|'.join(re.escape(q) for q in quotes)), string, re.DOTALL):
+            quote = found.group()
+            if quote[0] == '\\': continue
+            if opened is None:
+                opened = quote
+                starts.append(found.start())
+            elif quote == opened:
+                opened = None
+                ends.append(found.end())
+        if opened is not None: ends.append(len(string))
+    chunks, start = [], 0
+    while len(string)-start > size:
+        cut = string.find(newline, start+size)
+        while cut > -1:
+            i = bisect.bisect_right(starts, cut)-1
+            if i < 0 or ends[i] <= cut: break
+            cut = string.find(newline, ends[i])
+        if cut < 0: break
+        cut += len(newline)
+        chunks.append((start, cut))
+        start = cut
+    if start < len(string) or not chunks: chunks.append((start, len(string)))
+    return chunks
+
+
+class ParallelLexer:
+    """Lexer splitting large inputs into chunks lexed in parallel by worker processes.
+
+    Input is split at newlines outside of triple-quoted strings (see splits()), and chunks are lexed
+    by a pool of processes using copies of given lexer.
+    Tokens are stored in the given lexer, with line numbers and offsets the same as if the input was
+    lexed serially: a chunk whose tokens would not line up with those of the previous one (because its
+    start turned out to be inside a token) is lexed again in the main process.
+
+    Rules are assumed not to match across newlines (strings, including triple-quoted ones, can).
+    """
+    def __init__(self, lxr, jobs=None, size=2**20):
+        self._lexer, self._jobs, self._size = lxr, jobs, size
+        self._string = ''
+
+    def lexer(self):
+        return self._lexer
+
+    def feed(self, s):
+        self._string = s
+        return self
+
+    def _stitch(self, string, chunks, results, indent, errors, mode):
+        """Generates tokens of chunks in the form generated by Lexer._scan(), using results of worker
+        processes where they can be used and lexing the string in the main process elsewhere.
+        """
+        lxr, pos = self._lexer, 0
+        for (start, end), result in zip(chunks, results):
+            if pos == start and lxr._char == 0 and result is not None:
+                tokens, stop, lines, char, begun, invalid, unclosed = result
+                for line, t_char, t_start, t_end, t_type, t_group, cooked in tokens:
+                    yield (lxr._line+line, t_char, start+t_start, start+t_end, t_type, t_group, cooked)
+                lxr._lines.extend(lxr._base+start+i for i in begun)
+                lxr._unclosed.extend(lxr._base+start+i for i in unclosed)
+                lxr._line, lxr._char = lxr._line+lines, char
+                lxr._invalid = (lxr._invalid[0]+invalid[0], lxr._invalid[1]+invalid[1])
+                pos = start+stop
+            elif pos < end:
+                yield from lxr._scan(string, pos, end, True, indent, errors, mode)
+                pos = lxr._pos
+
+    def tokenize(self, indent=False, errors='throw', mode='simple'):
+        """Generate tokens from the string received (see Lexer.tokenize()).
+        Small inputs, lexers with rules that cannot be copied to worker processes, and
+        the 'inspect' matching mode (whose warnings would be issued in workers) are lexed serially.
+        """
+        lxr, string = self._lexer.feed(self._string), self._string
+        lxr.compile()
+        chunks = splits(string, self._size, lxr._flags['newline'], [q for q, t_type in lxr._quotes if len(q) == 3])
+        if len(chunks) < 2 or self._jobs == 1 or mode == 'inspect' or not all(isinstance(r, lexer.LexerRule) for r in lxr.rules()):
+            lxr.tokenize(indent, errors, mode)
+            return self
+        if mode not in lxr._modes: raise ValueError('unknown matching mode: {0}'.format(mode))
+        lxr._invalid, lxr._options, lxr._unclosed, lxr._resume = (0, 0), (indent, errors, mode), [], None
+        with concurrent.futures.ProcessPoolExecutor(self._jobs, initializer=_initWorker, initargs=(lxr.dumps(),)) as pool:
+            results = pool.map(_lexChunk, [string[start:end] for start, end in chunks], [end == len(string) for start, end in chunks],
+                               itertools.repeat(indent), itertools.repeat(errors), itertools.repeat(mode))
+            lxr._store(string, self._stitch(string, chunks, results, indent, errors, mode))
+        return self
+
+    def tokens(self, raw=False):
+        return self._lexer.tokens(raw)
+
+    def invalid(self):
+        return self._lexer.invalid()
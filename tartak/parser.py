@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import collections
+import itertools
 import json
 import sys
 import re
@@ -90,6 +92,397 @@ def deserialize(pattern):
 
 # New code begins here, above functions and classes SHOULD NOT be used
 
+class Memo:
+    """Memo table used by packrat parsing.
+    Maps (rule, position) keys to results of matching the rule at that position.
+
+    Every result is stored with its reach: position just past the last token examined to obtain it,
+    so results not affected by an edit of the token stream can be kept (see .edit()).
+    Results are kept in rows, one for every position of the stream, with their ends and reaches stored
+    relative to the position, so results following an edit need not be touched to be shifted.
+
+    If limit is given, the table never holds more than that many entries and the oldest
+    entries are evicted first.
+    """
+    def __init__(self, limit=None):
+        self._limit = limit
+        self.clear()
+
+    def __len__(self):
+        return self._size
+
+    def _entry(self, key):
+        """Returns entry stored under given key, or None if there is none.
+        An entry stored before the last edit is checked against edits made since, and dropped if it
+        examined any of the replaced tokens.
+        """
+        rule, pos, kind = key
+        row = (self._rows[pos] if pos < len(self._rows) else None)
+        entry = (None if row is None else row.get((rule, kind)))
+        if entry is None or entry[3] == len(self._edits): return entry
+        at = pos
+        for start, end, count in reversed(self._edits[entry[3]:]):
+            if at >= start+count: at -= count-(end-start)
+            elif at+entry[2] > start:
+                self._drop(row, (rule, kind))
+                return None
+        entry = row[(rule, kind)] = entry[:3] + (len(self._edits),)
+        return entry
+
+    def _store(self, key, result, reach):
+        rule, pos, kind = key
+        if self._limit is not None:
+            if self._limit < 1: return
+            while self._size >= self._limit: self._drop(*self._order.popitem(last=False)[1])
+        rows = self._rows
+        if pos >= len(rows): rows.extend([None] * (pos+1-len(rows)))
+        row = rows[pos]
+        if row is None: row = rows[pos] = {}
+        elif (rule, kind) in row: self._drop(row, (rule, kind))
+        row[(rule, kind)] = (result[0], result[1]-pos, reach-pos, len(self._edits))
+        self._size += 1
+        if self._limit is not None: self._order[(id(row), rule, kind)] = (row, (rule, kind))
+
+    def _drop(self, row, sub):
+        del row[sub]
+        self._size -= 1
+        if self._limit is not None: self._order.pop((id(row),) + sub, None)
+
+    def get(self, key):
+        """Returns memoized result, or None if there is none.
+        Reach of the result is added to the reach of the match in progress.
+        """
+        entry = self._entry(key)
+        if entry is None: return None
+        pos = key[1]
+        if pos+entry[2] > self._reach: self._reach = pos+entry[2]
+        return (entry[0], pos+entry[1])
+
+    def track(self, pos):
+        """Begins tracking reach of a match starting at given position.
+        Returns reach of the enclosing match, which must be passed to .put().
+        """
+        outer, self._reach = self._reach, pos
+        return outer
+
+    def put(self, key, result, outer=0):
+        """Memoizes result and returns it.
+        Reach of the result is added to the reach of the enclosing match.
+        """
+        reach = max(self._reach, result[1]+1)
+        self._reach = max(outer, reach)
+        self._store(key, result, reach)
+        return result
+
+    def repeat(self, rule, pos, n, step):
+        """Matches repetitions of rule from given position for as long as they match and there are tokens left;
+        step(i) matches one repetition at position i.
+        Returns the same as a loop of steps would: a tuple of a boolean telling whether the last repetition matched
+        and position at which the last matched repetition ended.
+
+        Runs of repetitions are memoized as well: a run of level 0 is one repetition, and two adjacent
+        runs of the same level are joined into a run of the next level, so after an edit the repetitions
+        before and after it are skipped in a number of steps that grows with the logarithm of their count.
+        """
+        outer, i, match, runs = self._reach, pos, True, []
+        while match and i < n:
+            self._reach, run = i, None
+            for level in itertools.count(1):
+                entry = self._entry((rule, i, level))
+                if entry is None: break
+                run = (level, i, i+entry[1], i+entry[2])
+            if run is None:
+                match, end = step(i)
+                if not match: break
+                run = (0, i, end, max(self._reach, end))
+            i = run[2]
+            while runs and runs[-1][0] == run[0]:
+                left = runs.pop()
+                run = (run[0]+1, left[1], run[2], max(left[3], run[3]))
+                self._store((rule, run[1], run[0]), (True, run[2]), run[3])
+            runs.append(run)
+        self._reach = max([outer, self._reach] + [run[3] for run in runs])
+        return (match, i)
+
+    def edit(self, start, end, count):
+        """Updates memo after tokens between positions start and end were replaced with count tokens.
+        Results that examined any of the replaced tokens are dropped, and positions of results
+        following them are shifted.
+
+        Only rows of the replaced tokens are dropped here; other results are checked when they
+        are looked up, so the time taken grows with the size of the edit, not of the memo.
+        """
+        for row in self._rows[start:end]:
+            for sub in list(row or ()): self._drop(row, sub)
+        if start < len(self._rows): self._rows[start:end] = [None] * count
+        self._edits.append((start, end, count))
+        return self
+
+    def clear(self):
+        self._rows, self._edits, self._order, self._size, self._reach = [], [], collections.OrderedDict(), 0, 0
+        return self
+
+
+class Matcher:
+    """Matcher compiled from an item of a rule (see Parser.compile()).
+    Matching is done by .step(tokens, i, n, memo), where n is the length of the token stream;
+    it returns a tuple of a boolean telling whether the item matched and position at which the match ended,
+    the same as Parser._matchat() gives for a rule made of the item.
+    The step is chosen when the matcher is created, according to the quantifier of the item.
+
+    Matchers also know which tokens may begin them: unless the first token is matched by one of
+    the cell matchers in ._first, the step gives ._miss, a (match, length) pair.
+    Both are None when they cannot be known in advance.
+    """
+    def __init__(self, quantifier=None):
+        self._quantifier = quantifier
+        steps = {None: self._one, '?': self._optional, '*': self._star, '+': self._plus}
+        if quantifier not in steps: raise ValueError('invalid quantifier: {0}'.format(quantifier))
+        self.step = steps[quantifier]
+        self._first, self._miss = None, None
+
+    def match(self, tokens, pos=0, memo=None):
+        """Matches at given position of token stream.
+        """
+        return self.step(tokens, pos, len(tokens), memo)
+
+
+class CellMatcher(Matcher):
+    """Matcher of single tokens; subclasses test the token at given index of the stream in .test().
+    """
+    def __init__(self, quantifier=None):
+        super().__init__(quantifier)
+        self._first = frozenset([self])
+        self._miss = {None: (False, 1), '?': (True, 0), '*': (True, 0), '+': (False, 0)}[quantifier]
+
+    def _one(self, tokens, i, n, memo):
+        if i > n: raise errors.EndOfTokenStreamError('unexpected end of token stream')
+        return (self.test(tokens, i), i+1)
+
+    def _optional(self, tokens, i, n, memo):
+        if i < n and self.test(tokens, i): i += 1
+        return (True, i)
+
+    def _star(self, tokens, i, n, memo):
+        test = self.test
+        while i < n and test(tokens, i): i += 1
+        return (True, i)
+
+    def _plus(self, tokens, i, n, memo):
+        if i > n: raise errors.EndOfTokenStreamError('unexpected end of token stream')
+        if not (i < n and self.test(tokens, i)): return (False, i)
+        return self._star(tokens, i+1, n, memo)
+
+
+class StringMatcher(CellMatcher):
+    def __init__(self, value, quantifier=None):
+        super().__init__(quantifier)
+        self._value = value
+
+    def test(self, tokens, i):
+        return tokens[i].value() == self._value
+
+
+class IdentifierMatcher(CellMatcher):
+    """Matcher of tokens by group and type, either of which may be empty to match any.
+    """
+    def __init__(self, t_group, t_type, quantifier=None):
+        super().__init__(quantifier)
+        self._group, self._type = t_group, t_type
+        if not t_group: self.test = self._testType
+        if not t_type: self.test = self._testGroup
+        if not (t_group or t_type): self.test = self._testAny
+
+    def test(self, tokens, i):
+        token = tokens[i]
+        return token.type() == self._type and token.group() == self._group
+
+    def _testType(self, tokens, i):
+        return tokens[i].type() == self._type
+
+    def _testGroup(self, tokens, i):
+        return tokens[i].group() == self._group
+
+    def _testAny(self, tokens, i):
+        return tokens[i] is not None # past the end of the stream, fails like Parser.cellmatch()
+
+
+class SymbolMatcher(CellMatcher):
+    """Matcher of tokens whose symbol code (see tokens.SymbolTable) is in given set of codes.
+    Codes are read from the token stream, without making token objects (see TokenStream.code()).
+    """
+    def __init__(self, codes, quantifier=None):
+        super().__init__(quantifier)
+        self._codes = codes
+
+    def test(self, tokens, i):
+        return tokens.code(i) in self._codes
+
+
+class NestedMatcher(Matcher):
+    """Matcher of groups and alternatives; subclasses match one repetition in ._match(),
+    which is memoized under given kind if a memo is given (see Parser.matchat()).
+
+    A repetition is neither looked up in the memo nor matched when the next token cannot begin it;
+    whether a token can is found by testing it with cell matchers of the lookahead once for every kind of token
+    (see ._key()).
+    If coded is True, tokens are told apart by their symbol codes (see Parser.compile()).
+    """
+    _kind = None
+
+    def __init__(self, quantifier=None, coded=False):
+        super().__init__(quantifier)
+        self._coded = coded
+        self._repeated, self._literals, self._starts = (None, None), frozenset(), {}
+
+    def _lookahead(self, first, miss):
+        """Sets lookahead of the matcher, given FIRST set and miss of one repetition.
+        """
+        self._repeated = (first, miss)
+        if first is None: return
+        self._literals = frozenset(cell._value for cell in first if isinstance(cell, StringMatcher))
+        if self._quantifier is None: self._first, self._miss = first, miss
+        elif self._quantifier == '?': self._first, self._miss = first, (True, (miss[1] if miss[0] else 0))
+        elif not miss[0]: self._first, self._miss = first, (False, 0)
+
+    def _key(self, tokens, i):
+        """Returns key of token at given index; cell matchers of the lookahead give the same results
+        for all tokens with the same key.
+        """
+        if self._coded:
+            key = tokens.code(i)
+        else:
+            token = tokens[i]
+            key = (token.group(), token.type())
+        if not self._literals: return key
+        value = tokens[i].value()
+        return (key, (value if value in self._literals else None))
+
+    def _memoized(self, tokens, i, n, memo):
+        first, miss = self._repeated
+        if first is not None and i < n:
+            key = self._key(tokens, i)
+            starts = self._starts.get(key)
+            if starts is None: starts = self._starts[key] = any(cell.test(tokens, i) for cell in first)
+            if not starts: return (miss[0], i+miss[1])
+        if memo is None: return self._match(tokens, i, n, memo)
+        key = (id(self), i, self._kind)
+        result = memo.get(key)
+        if result is None:
+            outer = memo.track(i)
+            result = memo.put(key, self._match(tokens, i, n, memo), outer)
+        return result
+
+    def _one(self, tokens, i, n, memo):
+        if i > n: raise errors.EndOfTokenStreamError('unexpected end of token stream')
+        return self._memoized(tokens, i, n, memo)
+
+    def _optional(self, tokens, i, n, memo):
+        if i < n:
+            result = self._memoized(tokens, i, n, memo)
+            if result[0]: return result
+        return (True, i)
+
+    def _star(self, tokens, i, n, memo):
+        if memo is not None: return memo.repeat(id(self), i, n, lambda j: self._memoized(tokens, j, n, memo))
+        match = True
+        while match and i < n:
+            match, end = self._memoized(tokens, i, n, memo)
+            if match: i = end
+        return (match, i)
+
+    def _plus(self, tokens, i, n, memo):
+        if i > n: raise errors.EndOfTokenStreamError('unexpected end of token stream')
+        match, end = (self._memoized(tokens, i, n, memo) if i < n else (False, i))
+        if not match: return (False, i)
+        return self._star(tokens, end, n, memo)
+
+
+class SequenceMatcher(NestedMatcher):
+    """Matcher of a rule, or of a group.
+    """
+    _kind = 'rule'
+
+    def __init__(self, items, quantifier=None, coded=False):
+        super().__init__(quantifier, coded)
+        self._steps = [item.step for item in items]
+        self._lookahead(*self._sequenced(items))
+
+    def _sequenced(self, items):
+        """Returns FIRST set and miss of a sequence of items: items are added to FIRST set for
+        as long as they may be missed without consuming tokens.
+        """
+        first, miss = frozenset(), (False, 0)
+        for k, item in enumerate(items):
+            if item._first is None: return (None, None)
+            first, miss = first | item._first, item._miss
+            if not miss[0]: break
+            if miss[1] and k < len(items)-1: return (None, None)
+        return (first, miss)
+
+    def _match(self, tokens, i, n, memo):
+        match = False
+        for step in self._steps:
+            match, i = step(tokens, i, n, memo)
+            if not match: break
+        return (match, i)
+
+
+class AlternativeMatcher(NestedMatcher):
+    """Matcher of alternatives, of which the first to match wins.
+    Alternatives that cannot begin with the next token are not tried; lists of alternatives to try
+    are kept for every kind of token (see NestedMatcher._key()).
+    """
+    _kind = 'alternative'
+
+    def __init__(self, alternatives, quantifier=None, coded=False):
+        super().__init__(quantifier, coded)
+        self._alternatives = alternatives
+        self._steps, self._dispatch = [alt.step for alt in alternatives], {}
+        self._lookahead(*self._alternated(alternatives))
+        self._literals = frozenset(cell._value for alt in alternatives for cell in (alt._first or ()) if isinstance(cell, StringMatcher))
+        self._dispatched = any(alt._first is not None for alt in alternatives)
+
+    def _alternated(self, alternatives):
+        """Returns FIRST set and miss of alternatives: alternatives are added to FIRST set
+        until one that succeeds when it is missed.
+        """
+        first, miss = frozenset(), (False, 0)
+        for alt in alternatives:
+            if alt._first is None: return (None, None)
+            first, miss = first | alt._first, alt._miss
+            if miss[0]: break
+        return (first, miss)
+
+    def _alternativesFor(self, tokens, i):
+        """Returns steps of alternatives to try for token at given index, and result to give
+        if none of them matches (None if it is the result of the last one).
+        """
+        steps, result = [], None
+        for alt in self._alternatives:
+            if alt._first is None or any(cell.test(tokens, i) for cell in alt._first):
+                steps.append(alt.step)
+                result = None
+                continue
+            result = alt._miss
+            if result[0]: break
+        return (steps, result)
+
+    def _match(self, tokens, i, n, memo):
+        steps, result = self._steps, None
+        if self._dispatched and i < n:
+            key = self._key(tokens, i)
+            dispatched = self._dispatch.get(key)
+            if dispatched is None: dispatched = self._dispatch[key] = self._alternativesFor(tokens, i)
+            steps, result = dispatched
+        match, end = False, i
+        for step in steps:
+            match, end = step(tokens, i, n, memo)
+            if match: return (match, end)
+        if result is not None: return (result[0], i+result[1])
+        return (match, end)
+
+
 class Parser:
     def __init__(self, lexer):
         self._lexrules = lexer._rules
@@ -110,63 +503,144 @@ class Parser:
         return match
 
     @classmethod
-    def altmatch(self, cell, stream):
+    def altmatch(self, cell, stream, memo=None):
         """Matches alternatives.
         """
-        match, count = False, 0
+        return Parser.altmatchat(cell, stream, 0, memo)
+
+    @classmethod
+    def matchrule(self, rule, tokens, memo=None):
+        """Matches rule against the beginning of token stream.
+        Returns a tuple of a boolean telling whether the rule matched and number of tokens consumed.
+
+        If memo is given, results of matching rules, groups and alternatives at each position of the
+        stream are stored in it and reused (packrat parsing), which keeps grammars with heavy
+        alternation and backtracking from running in exponential time.
+        A memo is valid only for one stream and a set of rule objects that do not change.
+        Rule may be compiled with .compile().
+        """
+        if isinstance(rule, Matcher): return rule.match(tokens, 0, memo)
+        return Parser.matchat(rule, tokens, 0, memo)
+
+    @classmethod
+    def compile(self, rule, symbols=None):
+        """Compiles rule into a matcher giving the same results as matching the rule with .matchrule(),
+        without examining the structure of the rule for every token.
+        Compiled rule is matched with its .match() method, or passed to .matchrule() and .reparse()
+        in place of the rule.
+
+        If symbols is given, it must be the symbol table of the lexer that makes the tokens (see Lexer.symbols());
+        tokens are then matched by comparing codes of their groups and types instead of strings.
+        """
+        return SequenceMatcher([Parser._compileitem(item, symbols) for item in rule], None, symbols is not None)
+
+    @classmethod
+    def _compileitem(self, item, symbols=None):
+        quantifier = item.get('quantifier')
+        if item['type'] == 'string': return StringMatcher(item['value'], quantifier)
+        if item['type'] == 'identifier':
+            t_group, t_type = (item['value'].split(':') if ':' in item['value'] else ('', item['value']))
+            if symbols is None or not (t_group or t_type): return IdentifierMatcher(t_group, t_type, quantifier)
+            if not t_group: return SymbolMatcher(symbols.type(t_type), quantifier)
+            if not t_type: return SymbolMatcher(symbols.group(t_group), quantifier)
+            return SymbolMatcher(frozenset([symbols.code(t_group, t_type)]), quantifier)
+        if item['type'] == 'alternative':
+            return AlternativeMatcher([Parser._compileitem(alt, symbols) for alt in item['value']], quantifier, symbols is not None)
+        return SequenceMatcher([Parser._compileitem(sub, symbols) for sub in item['value']], quantifier, symbols is not None)
+
+    @classmethod
+    def reparse(self, rule, tokens, memo, start, end, count):
+        """Matches rule against the beginning of token stream after tokens between positions start and end
+        of the stream last matched using given memo were replaced with count tokens (see Lexer.edited()).
+        Memoized results that did not examine any of the replaced tokens are reused, so only
+        rules spanning the edit are matched again.
+        """
+        memo.edit(start, end, count)
+        return Parser.matchrule(rule, tokens, memo)
+
+    @classmethod
+    def altmatchat(self, cell, tokens, pos, memo=None):
+        """Matches alternatives at given position of token stream.
+        """
+        if memo is not None:
+            key = (id(cell), pos, 'alternative')
+            result = memo.get(key)
+            if result is not None: return result
+            outer = memo.track(pos)
+        match, end = False, pos
         for alt in cell:
-            match, count = Parser.matchrule([alt], stream)
+            match, end = Parser._matchat([alt], tokens, pos, memo)
             if match: break
-        return (match, count)
+        return ((match, end) if memo is None else memo.put(key, (match, end), outer))
 
     @classmethod
-    def matchrule(self, rule, tokens):
+    def matchat(self, rule, tokens, pos, memo=None):
+        """Matches rule at given position of token stream.
+        Returns a tuple of a boolean telling whether the rule matched and position at which the match ended.
+        Token stream is shared by all nested matches, they only pass positions around.
+        """
+        if memo is not None:
+            key = (id(rule), pos, 'rule')
+            result = memo.get(key)
+            if result is None:
+                outer = memo.track(pos)
+                result = memo.put(key, Parser._matchat(rule, tokens, pos, memo), outer)
+            return result
+        return Parser._matchat(rule, tokens, pos, memo)
+
+    @classmethod
+    def _matchat(self, rule, tokens, pos, memo=None):
         match = False
-        i = 0
+        i = pos
+        n = len(tokens)
         for item in rule:
             quantifier = item.get('quantifier')
-            if quantifier in [None, '+'] and i > len(tokens):
+            if quantifier in [None, '+'] and i > n:
                 raise errors.EndOfTokenStreamError('unexpected end of token stream')
             if quantifier is None:
                 if item['type'] in ['string', 'identifier']:
-                    match, count = Parser.cellmatch(item, tokens[i]), 1
+                    match = Parser.cellmatch(item, tokens[i])
+                    i += 1
                 elif item['type'] == 'alternative':
-                    match, count = Parser.altmatch(item['value'], tokens.slice(i))
+                    match, i = Parser.altmatchat(item['value'], tokens, i, memo)
                 else:
-                    match, count = Parser.matchrule(item['value'], tokens.slice(i))
-                i += count
+                    match, i = Parser.matchat(item['value'], tokens, i, memo)
             else:
                 if item['type'] in ['string', 'identifier']:
-                    if quantifier in ['+', '?'] and i < len(tokens) and Parser.cellmatch(item, tokens[i]):
+                    if quantifier in ['+', '?'] and i < n and Parser.cellmatch(item, tokens[i]):
                         match = True
                         i += 1
                     elif quantifier == '+':
                         match = False
                     else:
                         match = True
-                    while match and quantifier != '?' and i < len(tokens) and Parser.cellmatch(item, tokens[i]): i += 1
+                    while match and quantifier != '?' and i < n and Parser.cellmatch(item, tokens[i]): i += 1
                 elif item['type'] == 'alternative':
-                    if quantifier in ['+', '?'] and i < len(tokens) and Parser.altmatch(item['value'], tokens.slice(i))[0]:
-                        match, count = Parser.altmatch(item['value'], tokens.slice(i))
+                    first = (Parser.altmatchat(item['value'], tokens, i, memo) if quantifier in ['+', '?'] and i < n else (False, i))
+                    if first[0]:
+                        match, i = first
                     elif quantifier == '+':
-                        match, count = False, 0
+                        match = False
                     else:
-                        match, count = True, 0
-                    if match: i += count
-                    while match and quantifier != '?' and i < len(tokens):
-                        match, count = Parser.altmatch(item['value'], tokens.slice(i))
-                        if match: i += count
+                        match = True
+                    if match and quantifier != '?' and memo is not None:
+                        match, i = memo.repeat((id(item['value']), 'alternative'), i, n, lambda j: Parser.altmatchat(item['value'], tokens, j, memo))
+                    while match and quantifier != '?' and i < n:
+                        match, end = Parser.altmatchat(item['value'], tokens, i, memo)
+                        if match: i = end
                 else:
-                    if quantifier in ['+', '?'] and i < len(tokens) and Parser.matchrule(item['value'], tokens.slice(i))[0]:
-                        match, count = Parser.matchrule(item['value'], tokens.slice(i))
-                        i += count
+                    first = (Parser.matchat(item['value'], tokens, i, memo) if quantifier in ['+', '?'] and i < n else (False, i))
+                    if first[0]:
+                        match, i = first
                     elif quantifier == '+':
-                        match, count = False, 0
+                        match = False
                     else:
-                        match, count = True, 0
-                    while match and quantifier != '?' and i < len(tokens):
-                        match, count = Parser.matchrule(item['value'], tokens.slice(i))
-                        if match: i += count
+                        match = True
+                    if match and quantifier != '?' and memo is not None:
+                        match, i = memo.repeat((id(item['value']), 'rule'), i, n, lambda j: Parser.matchat(item['value'], tokens, j, memo))
+                    while match and quantifier != '?' and i < n:
+                        match, end = Parser.matchat(item['value'], tokens, i, memo)
+                        if match: i = end
             if not match: break
         return (match, i)
 
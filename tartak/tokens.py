@@ -1,22 +1,43 @@
 #!/usr/bin/env python3
 
+import array
+import bisect
+import copy
+import itertools
+import json
 import re
+import struct
+import sys
+
+from .errors import TokenFormatError
 
 
 # Token-related abstractions
 class Token:
     """Simple token object.
+    Tokens made by a lexer also carry the code of their group and type in lexer's symbol table
+    (see SymbolTable), which is None for other tokens.
     """
-    def __init__(self, line, char, value, t_type, t_group=''):
+    __slots__ = ('_line', '_char', '_group', '_type', '_value', '_code')
+
+    def __init__(self, line, char, value, t_type, t_group='', code=None):
         self._line, self._char = line, char
         self._group, self._type = t_group, t_type
         self._value = value
+        self._code = code
 
     def __str__(self):
-        return self._value
+        return self.value()
 
     def __repr__(self):
-        return '{0}:{1}({2}.{3}) :: {4}'.format(self._group, self._type, self._line, self._char, self._value)
+        return '{0}:{1}({2}.{3}) :: {4}'.format(self._group, self._type, self._line, self._char, self.value())
+
+    def _shifted(self, lines):
+        """Returns copy of the token moved by given number of lines.
+        """
+        token = copy.copy(self)
+        token._line += lines
+        return token
 
     def dumps(self):
         d = {
@@ -24,16 +45,18 @@ class Token:
             'char': self._char,
             't_group': self._group,
             't_type': self._type,
-            'value': self._value,
+            'value': self.value(),
         }
         return d
 
     def loads(self, d):
         """Loads token data from dict.
         """
-        self._line, self._group = d['line'], d['group']
-        self._group, self._type = d['group'], d['type']
+        self._line, self._char = d['line'], d['char']
+        self._group, self._type = d['t_group'], d['t_type']
         self._value = d['value']
+        self._code = None
+        return self
 
     def line(self):
         return self._line
@@ -47,32 +70,335 @@ class Token:
     def type(self):
         return self._type
 
+    def code(self):
+        return self._code
+
+    def value(self):
+        return self._value
+
+
+class LazyToken(Token):
+    """Token whose value is computed from its source text when it is requested for the first time.
+    Cook is called with group, type and source text of the token to get the value.
+    """
+    __slots__ = ('_cook',)
+
+    def __init__(self, line, char, text, t_type, t_group, cook, code=None):
+        super(LazyToken, self).__init__(line, char, text, t_type, t_group, code)
+        self._cook = cook
+
+    def loads(self, d):
+        super(LazyToken, self).loads(d)
+        self._cook = None
+        return self
+
     def value(self):
+        if self._cook is not None: self._value, self._cook = self._cook(self._group, self._type, self._value), None
         return self._value
 
 
+class SymbolTable:
+    """Interns (group, type) pairs of tokens as small integer codes.
+    Sets of codes of each group and each type are kept up to date as new codes are assigned.
+    """
+    def __init__(self):
+        self._codes = {}
+        self._symbols = []
+        self._groups, self._types = {}, {}
+
+    def __len__(self):
+        return len(self._symbols)
+
+    def code(self, group, t_type):
+        """Returns code of given group and type, assigning a new one if needed.
+        """
+        code = self._codes.get((group, t_type))
+        if code is None:
+            code = self._codes[(group, t_type)] = len(self._symbols)
+            self._symbols.append((group, t_type))
+            self._groups.setdefault(group, set()).add(code)
+            self._types.setdefault(t_type, set()).add(code)
+        return code
+
+    def group(self, group):
+        """Returns set of codes of given group.
+        The set is updated when codes are assigned to new pairs of the group.
+        """
+        return self._groups.setdefault(group, set())
+
+    def type(self, t_type):
+        """Returns set of codes of given type.
+        The set is updated when codes are assigned to new pairs of the type.
+        """
+        return self._types.setdefault(t_type, set())
+
+    def symbol(self, code):
+        """Returns (group, type) pair for given code.
+        """
+        return self._symbols[code]
+
+    def symbols(self):
+        return self._symbols
+
+
+class TokenColumns:
+    """Compact storage of tokens used by token streams.
+
+    Tokens are stored column-wise: lines and characters in arrays, groups and types as codes
+    from a symbol table, and values as (start, end) offsets into source string.
+    Token objects are only materialised when accessed.
+    If cook is given, it is called with group, type and source text of a token to get its value.
+    Values of tokens appended as objects are kept aside, as they need not come from the source.
+
+    Lines and offsets of tokens following the last splice are stored unshifted, and the shift
+    (see .splice()) is applied when they are read.
+    """
+    _ASIDE = -2**63
+
+    def __init__(self, source='', symbols=None, cook=None):
+        self._source = source
+        self._symbols = (symbols if symbols is not None else SymbolTable())
+        self._cook = cook
+        self._line, self._char = array.array('i'), array.array('I')
+        self._sym = array.array('H')
+        self._start, self._end = array.array('q'), array.array('q')
+        self._aside = []
+        self._shift = (0, 0, 0)
+
+    def __len__(self):
+        return len(self._sym)
+
+    def __iter__(self):
+        for i in range(len(self._sym)): yield self._token(i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice): return [self._token(n) for n in range(*i.indices(len(self)))]
+        if i < 0: i += len(self._sym)
+        return self._token(i)
+
+    def _token(self, i):
+        t_group, t_type = self._symbols.symbol(self._sym[i])
+        start, end = self._start[i], self._end[i]
+        if end == self._ASIDE:
+            value = self._aside[start]
+        else:
+            if i >= self._shift[0]: start, end = start+self._shift[2], end+self._shift[2]
+            value = self._source[start:end]
+            if self._cook is not None: value = self._cook(t_group, t_type, value)
+        return Token(self.line(i), self._char[i], value, t_type, t_group, self._sym[i])
+
+    def _settle(self, index):
+        """Moves the start of the pending shift (see .splice()) to given index, applying the shift to tokens
+        it passes over or taking it back from them.
+        """
+        at, lines, offset = self._shift
+        if lines or offset:
+            sign = (1 if index > at else -1)
+            line, start, end = self._line, self._start, self._end
+            for i in range(min(at, index), max(at, index)):
+                line[i] += sign*lines
+                if end[i] != self._ASIDE: start[i], end[i] = start[i]+sign*offset, end[i]+sign*offset
+        self._shift = ((index, lines, offset) if index < len(self) else (index, 0, 0))
+
+    def _new(self):
+        new = TokenColumns(self._source, self._symbols, self._cook)
+        new._aside = self._aside
+        return new
+
+    def source(self):
+        return self._source
+
+    def feed(self, source):
+        """Makes a new source available to tokens appended from now on.
+        Returns offset at which spans in the new source begin.
+        """
+        if not self._start or self._source is source:
+            self._source = source
+            return 0
+        base = len(self._source)
+        self._source += source
+        return base
+
+    def lines(self):
+        """Returns column of line numbers.
+        Pending shift (see .splice()) is applied to the column first.
+        """
+        self._settle(len(self))
+        return self._line
+
+    def line(self, i):
+        """Returns line number of token at given index.
+        """
+        if i < 0: i += len(self)
+        return self._line[i] + (self._shift[1] if i >= self._shift[0] else 0)
+
+    def offsets(self, i):
+        """Returns start and end offsets in the source of token at given index.
+        """
+        if i < 0: i += len(self)
+        start, end = self._start[i], self._end[i]
+        if i >= self._shift[0] and end != self._ASIDE: start, end = start+self._shift[2], end+self._shift[2]
+        return (start, end)
+
+    def bisect(self, column, value, right=False):
+        """Returns index at which value would be inserted into given column ('line' or 'end') keeping it sorted,
+        as bisect.bisect_left() (or bisect.bisect_right() if right is True) would.
+        All tokens must be backed by the source for the column of end offsets to be sorted.
+        """
+        at, lines, offset = self._shift
+        if column == 'line': return _bisect(self._line, value, at, lines, right)
+        return _bisect(self._end, value, at, offset, right)
+
+    def codes(self):
+        """Returns column of group and type codes (see SymbolTable).
+        """
+        return self._sym
+
+    def spans(self):
+        """Returns columns of start and end offsets of tokens in the source.
+        Pending shift (see .splice()) is applied to the columns first.
+        """
+        self._settle(len(self))
+        return (self._start, self._end)
+
+    def text(self, start=0, end=None):
+        """Returns source text of tokens in given range of indexes.
+        Spans of consecutive tokens are sliced from the source in one piece.
+        """
+        end = (len(self) if end is None else end)
+        parts, begin, stop = [], None, None
+        for i in range(start, end):
+            if self._end[i] == self._ASIDE:
+                if begin is not None: parts.append(self._source[begin:stop])
+                parts.append(self._aside[self._start[i]])
+                begin = None
+                continue
+            t_start, t_end = self.offsets(i)
+            if begin is None or t_start != stop:
+                if begin is not None: parts.append(self._source[begin:stop])
+                begin, stop = t_start, t_end
+            else:
+                stop = t_end
+        if begin is not None: parts.append(self._source[begin:stop])
+        return ''.join(parts)
+
+    def span(self, line, char, start, end, t_type, t_group):
+        """Appends token backed by the source.
+        """
+        at, lines, offset = self._shift
+        self._line.append(line-lines)
+        self._char.append(char)
+        self._sym.append(self._symbols.code(t_group, t_type))
+        self._start.append(start-offset)
+        self._end.append(end-offset)
+        return self
+
+    def append(self, token):
+        self._aside.append(token.value())
+        self._line.append(token.line()-self._shift[1])
+        self._char.append(token.char())
+        self._sym.append(self._symbols.code(token.group(), token.type()))
+        self._start.append(len(self._aside)-1)
+        self._end.append(self._ASIDE)
+        return self
+
+    def splice(self, first, last, columns, lines=0, offset=0, source=None):
+        """Replaces tokens in given range of indexes with tokens of given columns (which must use the same
+        symbol table), and shifts lines and offsets of tokens following the range by given amounts.
+        If source is given, it replaces the source of the tokens.
+
+        Tokens following the range are not touched: the shift is kept pending, together with the index it
+        starts at, and applied when they are read.
+        The pending shift of an earlier splice is moved to the range first, so the time taken grows with the
+        size of the range and its distance from the previous splice, not with the number of tokens after it.
+        """
+        self._settle(last)
+        columns._settle(len(columns))
+        at, held_lines, held_offset = self._shift
+        for column, spliced in zip((self._line, self._char, self._sym, self._start, self._end),
+                                   (columns._line, columns._char, columns._sym, columns._start, columns._end)):
+            column[first:last] = spliced
+        self._shift = (first+len(columns), held_lines+lines, held_offset+offset)
+        if source is not None: self._source = source
+        return self
+
+    def pop(self, i=-1):
+        token = self[i]
+        if i < 0: i += len(self)
+        for column in (self._line, self._char, self._sym, self._start, self._end): column.pop(i)
+        if i < self._shift[0]: self._shift = (self._shift[0]-1,) + self._shift[1:]
+        return token
+
+    def copy(self, start=0):
+        """Returns copy of the columns starting at given index.
+        """
+        new = self._new()
+        for column, copied in zip((self._line, self._char, self._sym, self._start, self._end), (new._line, new._char, new._sym, new._start, new._end)):
+            copied.extend(column[start:])
+        new._shift = (max(self._shift[0]-start, 0),) + self._shift[1:]
+        return new
+
+    def remove(self, group=None, t_type=None):
+        """Returns copy of the columns without tokens of given group or type.
+        """
+        dropped = set(code for code, (g, t) in enumerate(self._symbols.symbols()) if (group is not None and g == group) or (t_type is not None and t == t_type))
+        keep = [i for i, code in enumerate(self._sym) if code not in dropped]
+        new = self._new()
+        for column, copied in zip((self._line, self._char, self._sym, self._start, self._end), (new._line, new._char, new._sym, new._start, new._end)):
+            copied.extend([column[i] for i in keep])
+        new._shift = (bisect.bisect_left(keep, self._shift[0]),) + self._shift[1:]
+        return new
+
+
 class TokenStream:
     """Class representing token streams used by Tartak.
     """
-    def __init__(self, vector=()):
+    _MAGIC, _VERSION = b'TRTK', 1
+
+    def __init__(self, vector=(), columns=None):
         """Vector is any object that can be iterated and
         yields Token objects during iteration.
+        If columns (a TokenColumns object) are given, tokens are stored in them instead of a list.
         """
-        self._tokens = ([t for t in vector] if vector else [])
+        self._tokens = (columns if columns is not None else ([t for t in vector] if vector else []))
         self._head = 0
         self._points = []
+        self._shift = (0, 0)
 
     def __bool__(self):
         return len(self) > 0
 
     def __len__(self):
-        return len(self._tokens[self._head:])
+        return max(len(self._tokens) - self._head, 0)
 
     def __iter__(self):
-        return iter(self._tokens[self._head:])
+        self._settle(len(self._tokens))
+        return itertools.islice(self._tokens, self._head, None)
 
     def __getitem__(self, n):
-        return self._tokens[self._head+n]
+        return self._item(self._head+n)
+
+    def _item(self, i):
+        """Returns token at given index of the stored tokens.
+        Tokens stored as objects that follow the start of the pending shift are returned as shifted copies,
+        so reading a token far from the last splice does not settle the shift up to it.
+        """
+        token = self._tokens[i]
+        if not isinstance(self._tokens, TokenColumns) and self._shift[1]:
+            if i < 0: i += len(self._tokens)
+            if i >= self._shift[0]: token = token._shifted(self._shift[1])
+        return token
+
+    def _settle(self, index):
+        """Moves the start of the pending shift of lines of tokens stored as objects (see .splice()) to given index.
+        Tokens it passes over are replaced by their shifted copies, so tokens already returned do not change.
+        """
+        if isinstance(self._tokens, TokenColumns): return
+        at, lines = self._shift
+        if lines:
+            sign = (1 if index > at else -1)
+            for i in range(min(at, index), max(at, index)): self._tokens[i] = self._tokens[i]._shifted(sign*lines)
+        self._shift = ((index, lines) if index < len(self._tokens) else (index, 0))
 
     def __eq__(self, other):
         if len(self) != len(other): return False
@@ -109,7 +435,22 @@ class TokenStream:
     def get(self, at):
         """Returns token at given index.
         """
-        return self._tokens[ (self._head+at if at >= 0 else at) ]
+        return self._item(self._head+at if at >= 0 else at)
+
+    def line(self, at):
+        """Returns line of token at given index.
+        Pending shift (see .splice()) is not applied to stored tokens to get it.
+        """
+        i = self._head+at
+        if isinstance(self._tokens, TokenColumns): return self._tokens.line(i)
+        return self._tokens[i].line() + (self._shift[1] if i >= self._shift[0] else 0)
+
+    def code(self, at):
+        """Returns symbol code of token at given index (see Token.code()).
+        Tokens stored in columns are not made into objects to get it.
+        """
+        if isinstance(self._tokens, TokenColumns): return self._tokens.codes()[self._head+at]
+        return self._tokens[self._head+at].code()
 
     def slice(self, n, m=None, step=1):
         """Returns slice of the stream.
@@ -125,28 +466,61 @@ class TokenStream:
     def append(self, token):
         """Append token to stream.
         """
+        self._settle(len(self._tokens))
         self._tokens.append(token)
         return self
 
     def pop(self, n=0):
         """Pops a token at given index.
         """
-        return self._tokens.pop(0)
+        if isinstance(self._tokens, TokenColumns): return self._tokens.pop(0)
+        if not self._shift[0]: self._settle(min(1, len(self._tokens)))
+        token = self._tokens.pop(0)
+        self._shift = (max(self._shift[0]-1, 0), self._shift[1])
+        return token
+
+    def splice(self, first, last, tokens, lines=0, offset=0, source=None):
+        """Replaces tokens in given range of indexes with given tokens, and shifts lines of tokens
+        following the range by given number.
+        If tokens are stored in columns, tokens must be given as TokenColumns, and offsets of following
+        tokens are shifted as well (see TokenColumns.splice()).
+
+        Tokens following the range are not touched: the shift is kept pending and applied to them
+        when they are read, so the time taken does not grow with their number.
+        """
+        if isinstance(self._tokens, TokenColumns):
+            self._tokens.splice(first, last, tokens, lines, offset, source)
+            return self
+        self._settle(last)
+        self._tokens[first:last] = tokens
+        self._shift = (first+len(tokens), self._shift[1]+lines)
+        return self
+
+    def columns(self):
+        """Returns TokenColumns object storing tokens of this stream, or None if tokens are stored as objects.
+        """
+        return (self._tokens if isinstance(self._tokens, TokenColumns) else None)
 
     def remove(self, group=None, type=None):
         """Remove tokens from stream.
         """
+        if isinstance(self._tokens, TokenColumns):
+            self._tokens = self._tokens.remove(group, type)
+            return self
+        self._settle(len(self._tokens))
         tokens = []
         for t in self._tokens:
             if group is not None and t.group() == group: continue
             if type is not None and t.type() == type: continue
             tokens.append(t)
-        self._tokens = tokens
+        self._tokens, self._shift = tokens, (0, 0)
         return self
 
     def copy(self):
         """Return copy of current stream.
         """
+        if isinstance(self._tokens, TokenColumns): return TokenStream(columns=self._tokens.copy(self._head))
+        self._settle(len(self._tokens))
         new = TokenStream()
         for token in self._tokens[self._head:]: new.append(token)
         return new
@@ -156,3 +530,165 @@ class TokenStream:
         Used to serialize token streams.
         """
         return [token.dumps() for token in self]
+
+    def dump_binary(self, ofstream, source=None):
+        """Writes tokens to a binary file object in Tartak's binary token format.
+        If source is given, it is embedded in the output.
+
+        Layout (integers are little-endian):
+
+            header:     magic b'TRTK', version (u16), flags (u16), number of tokens (u32)
+            symbols:    string table of groups and types, group and type of each symbol in turn
+            values:     string table of distinct token values
+            records:    columns of lines (u32), characters (u32), symbol ids (u16) and value ids (u32)
+            source:     string table with single string, present if flag 1 is set
+
+        String table is a count (u32), byte lengths of the strings (u32 each) and UTF-8 encoded strings.
+        """
+        codes, symbols, ids, values = {}, [], {}, []
+        line, char, sym, value = array.array('I'), array.array('I'), array.array('H'), array.array('I')
+        for token in self:
+            key, v = (token.group(), token.type()), token.value()
+            if key not in codes:
+                codes[key] = len(codes)
+                symbols.extend(key)
+            if v not in ids:
+                ids[v] = len(values)
+                values.append(v)
+            line.append(token.line())
+            char.append(token.char())
+            sym.append(codes[key])
+            value.append(ids[v])
+        ofstream.write(struct.pack('<4sHHI', self._MAGIC, self._VERSION, (1 if source is not None else 0), len(line)))
+        _writeStrings(ofstream, symbols)
+        _writeStrings(ofstream, values)
+        for column in (line, char, sym, value): _writeArray(ofstream, column)
+        if source is not None: _writeStrings(ofstream, [source])
+        return self
+
+    @classmethod
+    def load_binary(self, ifstream):
+        """Reads token stream written by .dump_binary() from a binary file object.
+        Returns a pair of the stream and embedded source (None if the source was not embedded).
+        """
+        magic, version, flags, n = struct.unpack('<4sHHI', _read(ifstream, 12))
+        if magic != self._MAGIC: raise TokenFormatError('not a Tartak token file')
+        if version != self._VERSION: raise TokenFormatError('unsupported token file version: {0}'.format(version))
+        symbols = _readStrings(ifstream)
+        columns = TokenColumns()
+        for i in range(0, len(symbols), 2): columns._symbols.code(symbols[i], symbols[i+1])
+        columns._aside = _readStrings(ifstream)
+        value = array.array('I')
+        for column in (columns._line, columns._char, columns._sym, value): _readArray(ifstream, column, n)
+        columns._start = array.array('q', value)
+        columns._end = array.array('q', [TokenColumns._ASIDE]) * n
+        source = (_readStrings(ifstream)[0] if flags & 1 else None)
+        return (TokenStream(columns=columns), source)
+
+
+def _bisect(column, value, at, delta, right=False):
+    """Bisects sorted column whose items from given index on are stored less given delta.
+    """
+    find = (bisect.bisect_right if right else bisect.bisect_left)
+    i = find(column, value, 0, at)
+    return (i if i < at else find(column, value-delta, at))
+
+
+# Helpers of the binary token format
+def _read(ifstream, n):
+    data = ifstream.read(n)
+    if len(data) != n: raise TokenFormatError('truncated token file')
+    return data
+
+
+def _writeArray(ofstream, column):
+    if sys.byteorder != 'little':
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    ofstream.write(column.tobytes())
+
+
+def _readArray(ifstream, column, n):
+    column.frombytes(_read(ifstream, n * column.itemsize))
+    if sys.byteorder != 'little': column.byteswap()
+
+
+def _writeStrings(ofstream, strings):
+    encoded = [string.encode('utf-8') for string in strings]
+    ofstream.write(struct.pack('<I', len(encoded)))
+    _writeArray(ofstream, array.array('I', [len(e) for e in encoded]))
+    ofstream.write(b''.join(encoded))
+
+
+def _readStrings(ifstream):
+    n, = struct.unpack('<I', _read(ifstream, 4))
+    lengths = array.array('I')
+    _readArray(ifstream, lengths, n)
+    data, strings, offset = _read(ifstream, sum(lengths)), [], 0
+    for length in lengths:
+        strings.append(data[offset:offset+length].decode('utf-8'))
+        offset += length
+    return strings
+
+
+class TokenWriter:
+    """Writes tokens to a file object as they are produced.
+
+    With format 'json' tokens are written as JSON encoded list (the same text json.dumps(stream.dumps()) gives),
+    with format 'ndjson' every token is written as JSON object on its own line.
+    """
+    def __init__(self, ofstream, format='json'):
+        if format not in ('json', 'ndjson'): raise ValueError('unknown token format: {0}'.format(format))
+        self._ofstream, self._format = ofstream, format
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def write(self, token):
+        """Writes single token.
+        """
+        data = json.dumps(token.dumps())
+        if self._format == 'ndjson': self._ofstream.write(data + '\n')
+        else: self._ofstream.write(('[' if not self._count else ', ') + data)
+        self._count += 1
+        return self
+
+    def extend(self, tokens):
+        """Writes all tokens from given iterable.
+        """
+        for token in tokens: self.write(token)
+        return self
+
+    def close(self):
+        """Finishes the output; the file object is not closed.
+        """
+        if self._format == 'json': self._ofstream.write(('[' if not self._count else '') + ']')
+        return self
+
+
+class TokenReader:
+    """Reads tokens written by TokenWriter, in either format, from a file object.
+    Input is read in chunks of given size and tokens are generated one by one.
+    """
+    _separators = re.compile(r'[\s,\[\]]*')
+
+    def __init__(self, ifstream, size=2**16):
+        self._ifstream, self._size = ifstream, size
+
+    def __iter__(self):
+        decoder = json.JSONDecoder()
+        buffer, pos, eof = '', 0, False
+        while True:
+            pos = self._separators.match(buffer, pos).end()
+            if pos < len(buffer):
+                try:
+                    d, pos = decoder.raw_decode(buffer, pos)
+                    yield Token(line=d['line'], char=d['char'], value=d['value'], t_type=d['t_type'], t_group=d['t_group'])
+                    continue
+                except json.JSONDecodeError:
+                    if eof: raise
+            elif eof:
+                return
+            chunk = self._ifstream.read(self._size)
+            buffer, pos, eof = buffer[pos:] + chunk, 0, (chunk == '')
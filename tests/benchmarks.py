@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""Rough performance benchmarks for Tartak.
+
+They are not part of the test suite; run them with `make bench` and compare the numbers
+before and after changes to lexer or parser internals.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+if '--no-path-guess' not in sys.argv:
+    if os.path.split(os.getcwd())[1] == 'tests': sys.path.insert(0, '..') # is current directory is named 'tests', assume we are in testing directory
+    else: sys.path.insert(0, '.')
+
+import tartak
+
+
+SAMPLE = '''def answer(x, y):
+    if x == 42:
+        return 'forty-two'
+    elif y:
+        return """multi
+line"""
+    return x + y * 0x2a
+
+'''
+
+
+# Helper functions
+def getPythonLexer():
+    lxr = tartak.lexer.Lexer()
+    lxr.setFlag('string-dbl-triple').setFlag('string-sgl-triple')
+    for kw in ['def', 'if', 'elif', 'else', 'return', 'while', 'for', 'in', 'import', 'from', 'class']:
+        lxr.append(tartak.lexer.StringRule(group='keyword', name=kw, pattern=kw))
+    for name, op in [('eq', '=='), ('assign', '='), ('plus', '+'), ('star', '*'), ('comma', ','), ('colon', ':'), ('lparen', '('), ('rparen', ')')]:
+        lxr.append(tartak.lexer.StringRule(group='operator', name=name, pattern=op))
+    lxr.append(tartak.lexer.RegexRule(group='integer', name='hex', pattern='0x[0-9a-fA-F]+'))
+    lxr.append(tartak.lexer.RegexRule(group='integer', name='dec', pattern='(0|[1-9][0-9]*)'))
+    lxr.append(tartak.lexer.RegexRule(group='name', name='name', pattern='[a-zA-Z_][a-zA-Z0-9_]*'))
+    return lxr
+
+
+def timeit(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+# Benchmarks
+def benchLexerScaling(steps=4, base=200):
+    """Tokenizing input twice as big should take roughly twice as long.
+    """
+    print('lexer: tokenize() scaling')
+    previous = None
+    for i in range(steps):
+        string = SAMPLE * (base * 2**i)
+        elapsed = timeit(lambda: getPythonLexer().feed(string).tokenize())
+        ratio = ('' if previous is None else '  x{0:.2f}'.format(elapsed / previous))
+        print('  {0:>9} chars: {1:.3f}s{2}'.format(len(string), elapsed, ratio))
+        previous = elapsed
+
+
+def benchStringRuleScaling(steps=4, base=40):
+    """Tokenizing with four times as many string rules should take roughly as long.
+    """
+    print('lexer: string rules scaling')
+    string = SAMPLE * 400
+    previous = None
+    for i in range(steps):
+        lxr = getPythonLexer()
+        for k in range(base * 4**i): lxr.append(tartak.lexer.StringRule(group='keyword', name='kw{0}'.format(k), pattern='{0}{1}'.format('adefirxy'[k % 8], k)))
+        elapsed = timeit(lambda: lxr.feed(string).tokenize())
+        ratio = ('' if previous is None else '  x{0:.2f}'.format(elapsed / previous))
+        print('  {0:>9} rules: {1:.3f}s{2}'.format(len(lxr.rules()), elapsed, ratio))
+        previous = elapsed
+
+
+def benchLongStringScaling(steps=4, base=2**14):
+    """Lexing a triple-quoted string twice as long should take roughly twice as long.
+    """
+    print('lexer: long string scaling')
+    previous = None
+    for i in range(steps):
+        string = '"""{0}"""'.format('a\\"\n' * (base * 2**i))
+        elapsed = timeit(lambda: getPythonLexer().feed(string).tokenize())
+        ratio = ('' if previous is None else '  x{0:.2f}'.format(elapsed / previous))
+        print('  {0:>9} chars: {1:.3f}s{2}'.format(len(string), elapsed, ratio))
+        previous = elapsed
+
+
+def benchStreamedStringScaling(steps=4, base=2**16):
+    """Streaming a triple-quoted string twice as long in chunks should take roughly twice as long.
+    """
+    print('lexer: streamed long string scaling')
+    previous = None
+    for i in range(steps):
+        source = 'x = """{0}"""\ny\n'.format('a\\"\n' * (base * 2**i)).encode('utf-8')
+        elapsed = timeit(lambda: list(getPythonLexer().iter_tokens(source)))
+        ratio = ('' if previous is None else '  x{0:.2f}'.format(elapsed / previous))
+        print('  {0:>9} bytes: {1:.3f}s{2}'.format(len(source), elapsed, ratio))
+        previous = elapsed
+
+
+def benchParserScaling(steps=4, base=12500):
+    """Matching a quantified group over a stream of N tokens.
+    """
+    print('parser: matchrule() scaling')
+    statement = [
+        {'type': 'identifier', 'quantifier': None, 'value': 'name:'},
+        {'type': 'string', 'quantifier': None, 'value': '='},
+        {'type': 'alternative', 'quantifier': None, 'value': [
+            {'type': 'identifier', 'quantifier': None, 'value': 'name:'},
+            {'type': 'identifier', 'quantifier': None, 'value': 'integer:'},
+        ]},
+        {'type': 'string', 'quantifier': None, 'value': ';'},
+    ]
+    rule = [{'type': 'group', 'quantifier': '*', 'value': statement}]
+    previous = None
+    for i in range(steps):
+        lxr = getPythonLexer().append(tartak.lexer.StringRule(group='operator', name='semicolon', pattern=';'))
+        tokens = lxr.feed('x = 42; y = x; ' * (base * 2**i // 8)).tokenize().tokens()
+        elapsed = timeit(tartak.parser.Parser.matchrule, rule, tokens)
+        ratio = ('' if previous is None else '  x{0:.2f}'.format(elapsed / previous))
+        print('  {0:>9} tokens: {1:.3f}s{2}'.format(len(tokens), elapsed, ratio))
+        previous = elapsed
+
+
+def benchAlternativeScaling(steps=4, base=4, size=40000):
+    """Matching statements of four times as many kinds should take roughly as long, as compiled alternatives
+    that cannot begin with the next token are not tried.
+    """
+    print('parser: alternatives scaling')
+    previous = None
+    for i in range(steps):
+        kinds = base * 4**i
+        lxr = getPythonLexer().append(tartak.lexer.StringRule(group='operator', name='semicolon', pattern=';'))
+        for k in range(kinds): lxr.append(tartak.lexer.StringRule(group='keyword', name='kw{0}'.format(k), pattern='kw{0}'.format(k)))
+        statements = [{'type': 'group', 'quantifier': None, 'value': [
+            {'type': 'string', 'quantifier': None, 'value': 'kw{0}'.format(k)},
+            {'type': 'identifier', 'quantifier': None, 'value': 'name:'},
+            {'type': 'string', 'quantifier': None, 'value': ';'},
+        ]} for k in range(kinds)]
+        rule = tartak.parser.Parser.compile([{'type': 'alternative', 'quantifier': '*', 'value': statements}], lxr.symbols())
+        tokens = lxr.feed(''.join('kw{0} x; '.format(k % kinds) for k in range(size // 3))).tokenize().tokens()
+        elapsed = timeit(tartak.parser.Parser.matchrule, rule, tokens, tartak.parser.Memo())
+        ratio = ('' if previous is None else '  x{0:.2f}'.format(elapsed / previous))
+        print('  {0:>9} kinds: {1:.3f}s{2}'.format(kinds, elapsed, ratio))
+        previous = elapsed
+
+
+def benchReparseScaling(steps=4, base=12500, edits=20):
+    """Reparsing after a one-line edit in the middle of a stream of N tokens should take the same time for any N.
+    """
+    print('parser: reparse() scaling')
+    statement = [
+        {'type': 'identifier', 'quantifier': None, 'value': 'name:'},
+        {'type': 'string', 'quantifier': None, 'value': '='},
+        {'type': 'identifier', 'quantifier': None, 'value': 'integer:'},
+        {'type': 'string', 'quantifier': None, 'value': ';'},
+    ]
+    rule = tartak.parser.Parser.compile([{'type': 'group', 'quantifier': '*', 'value': statement}])
+    for i in range(steps):
+        lxr = getPythonLexer().append(tartak.lexer.StringRule(group='operator', name='semicolon', pattern=';'))
+        lines = ['x = 42;\n'] * (base * 2**i // 4)
+        memo = tartak.parser.Memo()
+        tartak.parser.Parser.matchrule(rule, lxr.feed(''.join(lines)).tokenize().tokens(), memo)
+        offset = len(''.join(lines[:len(lines)//2]))
+        def reparse():
+            for _ in range(edits):
+                lxr.relex(offset, offset, 'y = 0;\n')
+                tartak.parser.Parser.reparse(rule, lxr.tokens(), memo, *lxr.edited())
+        elapsed = timeit(reparse)
+        print('  {0:>9} tokens: {1:.2f}ms per edit'.format(len(lxr.tokens()), 1000 * elapsed / edits))
+
+
+def benchTokenMemory(base=1600):
+    """Memory held by the token streams of object and compact lexers.
+    """
+    print('lexer: token storage memory')
+    string = SAMPLE * base
+    for compact in (False, True):
+        tracemalloc.start()
+        lxr = getPythonLexer().setFlag('compact', compact).feed(string).tokenize()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('  {0:>9}: {1:.1f}MiB for {2} tokens'.format(('compact' if compact else 'objects'), size / 2**20, len(lxr.tokens()) + len(lxr.tokens(raw=True))))
+
+
+if __name__ == '__main__':
+    benchLexerScaling()
+    benchStringRuleScaling()
+    benchLongStringScaling()
+    benchStreamedStringScaling()
+    benchTokenMemory()
+    benchParserScaling()
+    benchAlternativeScaling()
+    benchReparseScaling()
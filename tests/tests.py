@@ -71,6 +71,15 @@ class LexerTests(unittest.TestCase):
         self.assertEqual('whitespace', tokens[0].group())
         self.assertEqual('  ', tokens[0].value())
 
+    def testRawWhitespaceTokensWithMultiCharacterNewline(self):
+        string = 'if\r\n \t\r\n\r\n  pass'
+        lexer = getDefaultLexer(string).setFlag('newline', '\r\n')
+        tokens = lexer.tokenize().tokens(raw=True)
+        self.assertEqual(['if', '\r\n', ' \t', '\r\n', '\r\n', '  ', 'pass'], [t.value() for t in tokens])
+        self.assertEqual(['if', 'newline', 'tab', 'newline', 'newline', 'space', 'pass'], [t.type() for t in tokens])
+        self.assertEqual([0, 0, 1, 1, 2, 3, 3], [t.line() for t in tokens])
+        self.assertEqual(' \t\r\n', lexer.getline(1, rebuild=True))
+
     def testLexerIncludesIndentationInTokens(self):
         string = 'if 0:\n    pass'
         lexer = getDefaultLexer(string)
@@ -136,6 +145,23 @@ class LexerTests(unittest.TestCase):
             self.assertEqual('invalid', tokens[2].type())
             self.assertEqual('$', tokens[2].value())
 
+    def testUnrecognizedSequencesEndWhereRulesWithUnknownFirstCharactersMatch(self):
+        lexer = getDefaultLexer('$%7 answer').append(tartak.lexer.RegexRule(pattern='%\\d', name='percent', group='operator'))
+        tokens = lexer.tokenize(errors='save').tokens()
+        self.assertEqual(['$', '%7', 'answer'], [t.value() for t in tokens])
+
+    def testUnrecognizedSequenceBeforeUnclosedStringIsNotEmpty(self):
+        string = "x = $'''\"\\"
+        tokens = getDefaultLexer(string, triple_strings=True).tokenize(errors='save').tokens()
+        self.assertEqual(['invalid', 'single', 'invalid'], [t.type() for t in tokens][2:])
+        self.assertEqual(["$'", "\"\\"], [t.value() for t in tokens if t.type() == 'invalid'])
+
+    def testLexerCountsUnrecognizedSequences(self):
+        lexer = getDefaultLexer('$$ answer = 42 ? @@@')
+        self.assertEqual((3, 6), lexer.tokenize(errors='drop').invalid())
+        self.assertEqual((3, 6), lexer.tokenize(errors='save').invalid())
+        self.assertEqual((0, 0), getDefaultLexer('answer = 42').tokenize().invalid())
+
     def testLexingSinglequotedString(self):
         string = "s = 'string'"
         lexer = getDefaultLexer(string)
@@ -170,6 +196,285 @@ class LexerTests(unittest.TestCase):
         self.assertEqual('triple', tokens[2].type())
         self.assertEqual('string\n        ', tokens[2].value())
 
+    def testLexingStringsWithEscapedQuotes(self):
+        string = r's = "a\\" "b\"c\\\"" """d\""""'
+        lexer = getDefaultLexer(string, triple_strings=True)
+        tokens = lexer.tokenize().tokens(raw=True)
+        self.assertEqual([r'"a\\"', r'"b\"c\\\""', r'"""d\""""'], [t.value() for t in tokens if t.group() == 'string'])
+
+    def testLexingBrokenStringReportsPosition(self):
+        lexer = getDefaultLexer('x = "foo\\\nbar"')
+        with self.assertRaises(tartak.errors.LexerError) as context:
+            lexer.tokenize()
+        self.assertEqual('broken string on line 1, character 5:\nx = "foo\\\n---------^', str(context.exception))
+
+    def testLexingLongStringsWithEscapesAndNewlines(self):
+        n = 2**12
+        for quote in ['"', "'"]:
+            string = '{0}{1}{0} x'.format(quote*3, 'a\\{0}\n'.format(quote) * n + '\\\\' * n)
+            tokens = getDefaultLexer(string, triple_strings=True).tokenize().tokens()
+            self.assertEqual(2, len(tokens))
+            self.assertEqual('a\\{0}\n'.format(quote) * n + '\\' * n, tokens[0].value())
+            self.assertEqual(n, tokens[1].line())
+
+    def testStringRuleMatchesAtOffset(self):
+        rule = tartak.lexer.StringRule(group='keyword', name='if', pattern='if')
+        self.assertEqual('if', rule.match('x if', 2))
+        self.assertEqual(None, rule.match('x ifstream', 2))
+        self.assertEqual(None, rule.match('if', 1))
+
+    def testRegexRuleMatchesAtOffset(self):
+        variants = ['[0-9]+', '^[0-9]+']
+        for pattern in variants:
+            rule = tartak.lexer.RegexRule(group='integer', name='dec', pattern=pattern)
+            self.assertEqual('42', rule.match('x = 42;', 4))
+            self.assertEqual(None, rule.match('x = 42;', 3))
+
+    def testRegexRulesWithAnchorsMatchAtStartOfToken(self):
+        for pattern in ['a|^b', '(^b)', '\\Ab', '(?:^|x)b']:
+            lexer = getDefaultLexer('if b').append(tartak.lexer.RegexRule(pattern=pattern, name='b', group='b'))
+            lexer.rules().insert(0, lexer.rules().pop())
+            self.assertEqual(['if', 'b'], [t.value() for t in lexer.tokenize().tokens()])
+            self.assertEqual('b', lexer.tokens()[1].type())
+            self.assertEqual('b', lexer.rules()[0].match('x b', 2))
+
+    def testCustomRulesMatchingWholeStringAreGivenSlicedInput(self):
+        class Digits:
+            def group(self):
+                return 'integer'
+            def type(self):
+                return 'digits'
+            def match(self, string):
+                matched = re.match('[0-9]+', string)
+                return (matched.group() if matched is not None else None)
+        lexer = tartak.lexer.Lexer('x 42').append(Digits()).append(tartak.lexer.RegexRule(pattern='[a-z]+', name='name', group='name'))
+        self.assertEqual([('name', 'x'), ('digits', '42')], [(t.type(), t.value()) for t in lexer.tokenize().tokens()])
+        self.assertRaises(TypeError, lexer.append, object())
+
+    def testTokensReportLineAndCharacter(self):
+        string = 'if answer:\n    pass = 42'
+        lexer = getDefaultLexer(string)
+        tokens = lexer.tokenize().tokens()
+        self.assertEqual([(0, 0), (0, 3), (0, 9), (1, 4), (1, 9), (1, 11)], [(t.line(), t.char()) for t in tokens])
+
+    def testRawTokensRebuildInput(self):
+        string = 'if answer:\n\t pass = """foo\nbar"""  \n'
+        lexer = getDefaultLexer(string, triple_strings=True)
+        tokens = lexer.tokenize().tokens(raw=True)
+        self.assertEqual(string, ''.join([t.value() for t in tokens]))
+
+    def testRawTokensAreOffsetsIntoInput(self):
+        string = 'if answer:\n\t pass = """foo\nbar"""  \n'
+        lexer = getDefaultLexer(string, triple_strings=True).tokenize()
+        self.assertIs(string, lexer.tokens(raw=True).columns().source())
+        self.assertEqual(string, lexer.tokens(raw=True).columns().text())
+
+    def testGettingLines(self):
+        string = 'if answer:\n    pass $ 42\n'
+        lexer = getDefaultLexer(string).tokenize(errors='drop')
+        self.assertEqual('if answer:\n', lexer.getline(0, rebuild=True))
+        self.assertEqual('    pass  42\n', lexer.getline(1, rebuild=True))
+        self.assertEqual(['if', ' ', 'answer', ':', '\n'], [t.value() for t in lexer.getline(0)])
+        self.assertIsInstance(lexer.getline(3), IndexError)
+
+    def testGettingPositionOfOffset(self):
+        string = 'if answer:\n    pass = """foo\nbar"""\n42'
+        lexer = getDefaultLexer(string, triple_strings=True).tokenize()
+        self.assertEqual((0, 0), lexer.position(0))
+        self.assertEqual((1, 4), lexer.position(string.index('pass')))
+        self.assertEqual((2, 0), lexer.position(string.index('bar')))
+        self.assertEqual((3, 1), lexer.position(len(string)-1))
+
+    def testFusedRulesKeepRuleOrder(self):
+        lexer = tartak.lexer.Lexer('<= <')
+        lexer.append(tartak.lexer.StringRule(group='operator', name='lt', pattern='<'))
+        lexer.append(tartak.lexer.StringRule(group='operator', name='lte', pattern='<='))
+        lexer.append(tartak.lexer.StringRule(group='operator', name='assign', pattern='='))
+        tokens = lexer.tokenize().tokens()
+        self.assertEqual(['lt', 'assign', 'lt'], [t.type() for t in tokens])
+
+    def testFusedRulesMixWithUnfusableRules(self):
+        lexer = getDefaultLexer('aa = if')
+        lexer.rules().insert(0, tartak.lexer.RegexRule(group='name', name='double', pattern='(?P<c>[a-z])(?P=c)'))
+        self.assertEqual(None, lexer.rules()[0].fragment())
+        tokens = lexer.tokenize().tokens()
+        self.assertEqual(['double', 'assign', 'if'], [t.type() for t in tokens])
+
+    def testDispatchedRulesKeepRuleOrder(self):
+        lexer = tartak.lexer.Lexer('x1 12 1x')
+        lexer.append(tartak.lexer.RegexRule(group='name', name='short', pattern='[a-z][0-9]'))
+        lexer.append(tartak.lexer.RegexRule(group='any', name='word', pattern='\\w+'))
+        lexer.append(tartak.lexer.RegexRule(group='integer', name='dec', pattern='[0-9]+'))
+        tokens = lexer.tokenize().tokens()
+        self.assertEqual(['short', 'word', 'word'], [t.type() for t in tokens])
+        self.assertIsNone(lexer.rules()[1].first())
+
+    def testLongRunsOfStringRulesKeepRuleOrder(self):
+        string = '<= < ifx if iff @3@ @30@'
+        for fillers in (2, 40):
+            lexer = tartak.lexer.Lexer(string)
+            for i in range(fillers): lexer.append(tartak.lexer.StringRule(group='filler', name='f{0}'.format(i), pattern='@{0}@'.format(i)))
+            lexer.append(tartak.lexer.StringRule(group='operator', name='lt', pattern='<'))
+            lexer.append(tartak.lexer.StringRule(group='operator', name='lte', pattern='<='))
+            lexer.append(tartak.lexer.StringRule(group='operator', name='assign', pattern='='))
+            lexer.append(tartak.lexer.StringRule(group='keyword', name='if', pattern='if'))
+            lexer.append(tartak.lexer.StringRule(group='keyword', name='iff', pattern='iff'))
+            lexer.append(tartak.lexer.RegexRule(group='name', name='name', pattern='[a-z]+'))
+            lexer.append(tartak.lexer.RegexRule(group='filler', name='other', pattern='@[0-9]+@'))
+            tokens = lexer.tokenize().tokens()
+            self.assertEqual(['lt', 'assign', 'lt', 'name', 'if', 'iff', ('f3' if fillers > 3 else 'other'), ('f30' if fillers > 30 else 'other')], [t.type() for t in tokens])
+
+    def testCompiledRulesAreRebuiltWhenRulesChange(self):
+        lexer = getDefaultLexer('var')
+        self.assertEqual('name', lexer.tokenize().tokens()[0].type())
+        lexer = getDefaultLexer('var')
+        lexer.compile()
+        lexer.rules().insert(0, tartak.lexer.StringRule(group='keyword', name='var', pattern='var'))
+        self.assertEqual('var', lexer.tokenize().tokens()[0].type())
+
+    def testIteratingTokensFromChunksGivesSameTokensAsTokenizing(self):
+        string = 'if answer == 42:\n\tpass = """foo\nbar""" \'baz\'\n0x2a'
+        expected = [repr(t) for t in getDefaultLexer(string, triple_strings=True).tokenize(indent=True).tokens()]
+        for n in range(len(string)+1):
+            chunks = [string[:n], string[n:]]
+            tokens = getDefaultLexer(triple_strings=True).iter_tokens(chunks, indent=True)
+            self.assertEqual(expected, [repr(t) for t in tokens])
+
+    def testIteratingTokensWithUnclosedStringAfterInvalidSequence(self):
+        chunks = ['@if\'\'x@"""0if\n', '@y1pass\npass']
+        for errors in ('save', 'drop'):
+            lexer = getDefaultLexer(''.join(chunks), triple_strings=True).tokenize(errors=errors)
+            streamed = getDefaultLexer(triple_strings=True)
+            tokens = [repr(t) for t in streamed.iter_tokens(chunks, errors=errors, raw=True)]
+            self.assertEqual([repr(t) for t in lexer.tokens(raw=True)], tokens)
+            self.assertEqual(lexer.invalid(), streamed.invalid())
+
+    def testIteratingTokensWithStringsSplitAcrossManyChunks(self):
+        string = 'x = """a\\"\n\\\\""b\n"""\ny = "c\\"d"\n'
+        expected = [repr(t) for t in getDefaultLexer(string, triple_strings=True).tokenize().tokens(raw=True)]
+        for size in range(1, len(string)):
+            chunks = [string[i:i+size] for i in range(0, len(string), size)]
+            tokens = getDefaultLexer(triple_strings=True).iter_tokens(chunks, raw=True)
+            self.assertEqual(expected, [repr(t) for t in tokens])
+
+    def testIteratingTokensFromFile(self):
+        import io
+        string = 'if answer == 42:\n    pass\n' * 10
+        expected = [repr(t) for t in getDefaultLexer(string).tokenize().tokens(raw=True)]
+        tokens = getDefaultLexer().iter_tokens(io.StringIO(string), raw=True, size=7)
+        self.assertEqual(expected, [repr(t) for t in tokens])
+
+    def testIteratingTokensFromMemoryMappedFile(self):
+        import mmap
+        import tempfile
+        string = 'if "zażółć" == 42:\n    pass\n' * 10
+        expected = [repr(t) for t in getDefaultLexer(string).tokenize().tokens(raw=True)]
+        with tempfile.TemporaryFile() as ifstream:
+            ifstream.write(string.encode('utf-8'))
+            ifstream.flush()
+            source = mmap.mmap(ifstream.fileno(), 0, access=mmap.ACCESS_READ)
+            tokens = [repr(t) for t in getDefaultLexer().iter_tokens(source, raw=True, size=5, encoding='utf-8')]
+            source.close()
+        self.assertEqual(expected, tokens)
+
+    def testLongMatchingModeTakesLongestMatch(self):
+        lxr = getDefaultLexer('x = 0x1f == 0').tokenize(mode='long')
+        self.assertEqual(['x', '=', '0x1f', '==', '0'], [t.value() for t in lxr.tokens()])
+        self.assertEqual('hex', lxr.tokens().get(2).type())
+        lxr = getDefaultLexer('x = 0x1f').tokenize()
+        self.assertEqual(['x', '=', '0', 'x1f'], [t.value() for t in lxr.tokens()])
+
+    def testLongMatchingModePrefersEarlierRuleOfSameLength(self):
+        lxr = getDefaultLexer('if pass ifx').tokenize(mode='long')
+        self.assertEqual(['keyword:if', 'keyword:pass', 'name:name'], ['{0}:{1}'.format(t.group(), t.type()) for t in lxr.tokens()])
+
+    def testInspectMatchingModeWarnsAboutAmbiguousTokens(self):
+        import warnings
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            lxr = getDefaultLexer('x = 0x1f\ny = 42').tokenize(mode='inspect')
+        self.assertEqual(['x', '=', '0', 'x1f', 'y', '=', '42'], [t.value() for t in lxr.tokens()])
+        self.assertEqual(1, len(caught))
+        self.assertTrue(issubclass(caught[0].category, tartak.errors.LexerWarning))
+
+    def testDebugMatchingModeRaisesOnAmbiguousTokens(self):
+        self.assertRaises(tartak.errors.AmbiguousTokenError, getDefaultLexer('x = 0x1f').tokenize, mode='debug')
+        self.assertEqual(['y', '=', '42'], [t.value() for t in getDefaultLexer('y = 42').tokenize(mode='debug').tokens()])
+
+    def testUnknownMatchingModeIsRejected(self):
+        self.assertRaises(ValueError, getDefaultLexer('x').tokenize, mode='longest')
+
+    def testRegexRuleFirstCharacters(self):
+        self.assertEqual(frozenset('abc'), tartak.lexer.RegexRule(pattern='[a-c]x', name='r').first())
+        self.assertEqual(frozenset('ac'), tartak.lexer.RegexRule(pattern='(ab)*c', name='r').first())
+        self.assertIsNone(tartak.lexer.RegexRule(pattern='(?i)a', name='r').first())
+        self.assertIsNone(tartak.lexer.RegexRule(pattern='\\d+', name='r').first())
+
+    def testCompactTokensAreSameAsObjectTokens(self):
+        string = 'if answer == 42:\n    """yes\n\\"no\\""""\n\'a\\tb\'\n'
+        lxr = getDefaultLexer(string, triple_strings=True).tokenize()
+        compact = getDefaultLexer(string, triple_strings=True).setFlag('compact').tokenize()
+        self.assertIsNotNone(compact.tokens().columns())
+        self.assertEqual([repr(t) for t in lxr.tokens()], [repr(t) for t in compact.tokens()])
+        self.assertEqual([repr(t) for t in lxr.tokens(raw=True)], [repr(t) for t in compact.tokens(raw=True)])
+
+    def testTokensHaveNoInstanceDictionary(self):
+        tok = getDefaultLexer('if').tokenize().tokens().get(0)
+        self.assertFalse(hasattr(tok, '__dict__'))
+        self.assertIn(tok, {tok})
+
+    def testDecodingEscapeSequences(self):
+        self.assertEqual('a\nb\\n\t', tartak.lexer.decode('a\\nb\\\\n\\t'))
+        self.assertEqual('\\x41\\"', tartak.lexer.decode('\\x41\\"'))
+        self.assertEqual('Aą"\0', tartak.lexer.decode('\\x41\\u0105\\"\\0', escapes='full'))
+        self.assertEqual('a\\nb', tartak.lexer.decode('a\\nb', escapes='raw'))
+
+    def testEscapesFlagSetsDecodingOfStrings(self):
+        string = '"a\\tb\\x41"'
+        self.assertEqual('a\tb\\x41', getDefaultLexer(string).tokenize().tokens().get(0).value())
+        self.assertEqual('a\tbA', getDefaultLexer(string).setFlag('escapes', 'full').tokenize().tokens().get(0).value())
+        self.assertEqual('a\\tb\\x41', getDefaultLexer(string).setFlag('escapes', 'raw').tokenize().tokens().get(0).value())
+        self.assertRaises(ValueError, getDefaultLexer(string).setFlag('escapes', 'none').tokenize)
+
+    def testStringTokensAreDecodedLazily(self):
+        decoded = []
+        def cook(t_group, t_type, text):
+            decoded.append(text)
+            return tartak.lexer.cook(t_group, t_type, text)
+        tok = tartak.tokens.LazyToken(1, 0, '"a\\nb"', 'double', 'string', cook)
+        self.assertEqual([], decoded)
+        self.assertEqual('a\nb', tok.value())
+        self.assertEqual('a\nb', tok.value())
+        self.assertEqual(['"a\\nb"'], decoded)
+        self.assertEqual(tartak.tokens.Token(line=1, char=0, value='a\nb', t_type='double', t_group='string').dumps(), tok.dumps())
+
+    def testRelexingGivesSameTokensAsLexingEditedString(self):
+        string = 'if answer == 42:\n    pass\nx = "a"\nif y:\n    pass\n'
+        edits = [(3, 9, 'question'), (17, 26, ''), (0, 0, '"""\n'), (0, 4, ''), (30, 30, 'z = 0x2a\nw = 0o7\n')]
+        for flags in ([], ['compact']):
+            lxr = getDefaultLexer(string, triple_strings=True)
+            for flag in flags: lxr.setFlag(flag)
+            lxr.tokenize(errors='save')
+            edited = string
+            for start, end, text in edits:
+                edited = edited[:start] + text + edited[end:]
+                lxr.relex(start, end, text)
+                expected = getDefaultLexer(edited, triple_strings=True).tokenize(errors='save')
+                self.assertEqual([repr(t) for t in expected.tokens()], [repr(t) for t in lxr.tokens()])
+                self.assertEqual([repr(t) for t in expected.tokens(raw=True)], [repr(t) for t in lxr.tokens(raw=True)])
+                self.assertEqual(expected.invalid(), lxr.invalid())
+                self.assertEqual(expected.position(len(edited)), lxr.position(len(edited)))
+
+    def testRelexingClosesStringsOpenedBeforeTheEdit(self):
+        lxr = getDefaultLexer('x = """a\nb\nif c:\n    pass\n', triple_strings=True).tokenize(errors='save')
+        self.assertEqual('invalid', lxr.tokens().get(2).type())
+        lxr.relex(13, 13, '"""')
+        self.assertEqual(['name', 'assign', 'triple', 'name', 'colon', 'pass'], [t.type() for t in lxr.tokens()])
+        self.assertEqual('a\nb\nif', lxr.tokens().get(2).value())
+
+    def testRelexingRequiresTokenizedLexer(self):
+        self.assertRaises(ValueError, getDefaultLexer('if x: pass').relex, 0, 2, 'while')
+
 
 class LexerExporterTests(unittest.TestCase):
     def testExportingStringRule(self):
@@ -220,6 +525,55 @@ class LexerImporterTests(unittest.TestCase):
             self.assertEqual(lxr, tartak.lexer.Importer(string).make().lexer())
 
 
+class LexerCacheTests(unittest.TestCase):
+    def testCachingImportedLexer(self):
+        import tempfile
+        string = 'token string keyword:if = "if"; token regex integer:dec = "(0|[1-9][0-9]*)"; flag string_dbl_triple = true;'
+        with tempfile.TemporaryDirectory() as path:
+            cache = tartak.cache.LexerCache(path)
+            self.assertIsNone(cache.get(string))
+            lxr = cache.lexer(string)
+            self.assertEqual(lxr, tartak.lexer.Importer(string).parse().lexer())
+            self.assertEqual(lxr, cache.get(string))
+            self.assertEqual(['{0}.json'.format(cache.key(string))], os.listdir(path))
+
+    def testCacheKeyDependsOnRules(self):
+        cache = tartak.cache.LexerCache('')
+        self.assertEqual(cache.key('token string keyword:if = "if";'), cache.key('token string keyword:if = "if";'))
+        self.assertNotEqual(cache.key('token string keyword:if = "if";'), cache.key('token string keyword:if = "fi";'))
+
+    def testBrokenCacheEntriesAreIgnored(self):
+        import tempfile
+        string = 'token string keyword:if = "if";'
+        with tempfile.TemporaryDirectory() as path:
+            cache = tartak.cache.LexerCache(path)
+            with open(os.path.join(path, '{0}.json'.format(cache.key(string))), 'w') as ofstream: ofstream.write('{"rules": [')
+            self.assertIsNone(cache.get(string))
+            self.assertEqual(tartak.lexer.Importer(string).parse().lexer(), cache.lexer(string))
+            self.assertIsNotNone(cache.get(string))
+
+
+class ParallelLexerTests(unittest.TestCase):
+    def testSplittingAvoidsTripleQuotedStrings(self):
+        string = 'x = 1\n"""a\nb\nc"""\ny = 2\n'
+        self.assertEqual([(0, 6), (6, 18), (18, 24)], tartak.parallel.splits(string, 4, quotes=['"""']))
+        self.assertEqual([(0, 6), (6, 11), (11, 18), (18, 24)], tartak.parallel.splits(string, 4))
+
+    def testParallelTokensAreSameAsSerialTokens(self):
+        string = 'if answer == 42:\n    pass\n"""a\n"b"\n""" $ \'\'\'c\'\'\'\n' * 20
+        lxr = getDefaultLexer(string, triple_strings=True).tokenize(indent=True, errors='save')
+        parallel = tartak.parallel.ParallelLexer(getDefaultLexer(triple_strings=True), jobs=2, size=20).feed(string).tokenize(indent=True, errors='save')
+        self.assertEqual([repr(t) for t in lxr.tokens()], [repr(t) for t in parallel.tokens()])
+        self.assertEqual([repr(t) for t in lxr.tokens(raw=True)], [repr(t) for t in parallel.tokens(raw=True)])
+        self.assertEqual((20, 20), parallel.invalid())
+
+    def testParallelLexingReportsErrorsAtTheirLines(self):
+        string = 'answer = 42\n' * 10 + 'answer = $\n' + 'answer = 42\n' * 10
+        parallel = tartak.parallel.ParallelLexer(getDefaultLexer(), jobs=2, size=30).feed(string)
+        with self.assertRaises(tartak.errors.LexerError) as caught: parallel.tokenize()
+        self.assertIn('line 11, character 10', str(caught.exception))
+
+
 class TokenStreamTests(unittest.TestCase):
     def testPointingChangesPositionOfTheCursor(self):
         string = '"foo" "bar" "baz" "bay" "bax"'
@@ -275,6 +629,118 @@ class TokenStreamTests(unittest.TestCase):
         tokens.rewind(-200) # if the absolute value of a negative indexes is greater than length of the list of points, it results in rewinding the cursor to the beginning of the head
         self.assertEqual('foo', tokens.get(0).value())
 
+    def testCompactStreamsSupportStreamOperations(self):
+        string = '"foo" "bar" "baz" "bay" "bax"'
+        lxr = getDefaultLexer().setFlag('compact').feed(string).tokenize()
+        tokens = lxr.tokens()
+        self.assertEqual(5, len(tokens))
+        self.assertEqual(['bar', 'baz', 'bay', 'bax'], [i.value() for i in tokens.copy().point(1)])
+        self.assertEqual('bax', tokens.get(-1).value())
+        raw = lxr.tokens(raw=True).copy().remove('string', 'double')
+        self.assertEqual(4, len(raw))
+        self.assertEqual(' ', raw.pop().value())
+        self.assertEqual(3, len(raw))
+
+    def testSplicingColumnsLeavesFollowingTokensStoredAsTheyWere(self):
+        string = 'x = 1\ny = 2\nz = 3\n'
+        columns = getDefaultLexer(string).tokenize().tokens(raw=True).columns()
+        stored = (list(columns._line[6:]), list(columns._start[6:]))
+        spliced = getDefaultLexer('x = 10\n\n').tokenize().tokens(raw=True).columns()
+        columns.splice(0, 6, spliced, 1, 2, 'x = 10\n\ny = 2\nz = 3\n')
+        self.assertEqual(stored, (list(columns._line[7:]), list(columns._start[7:])))
+        self.assertEqual('x = 10\n\ny = 2\nz = 3\n', columns.text())
+        self.assertEqual([0, 0, 0, 0, 0, 0, 1, 2, 2, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3], [t.line() for t in columns])
+        self.assertEqual(13, columns.bisect('line', 3))
+        self.assertEqual(list(range(len(columns))), [columns.bisect('end', columns.offsets(i)[1]) for i in range(len(columns))])
+
+    def testSplicingTokensDoesNotChangeTokensAlreadyReturned(self):
+        lxr = getDefaultLexer('if x:\n    pass\n').tokenize()
+        token = lxr.tokens().get(3)
+        lxr.relex(0, 0, 'y\n')
+        self.assertEqual(1, token.line())
+        self.assertEqual(2, lxr.tokens().get(4).line())
+        self.assertEqual(2, lxr.tokens().line(4))
+
+    def testSymbolTableInternsPairs(self):
+        symbols = tartak.tokens.SymbolTable()
+        self.assertEqual(0, symbols.code('string', 'double'))
+        self.assertEqual(1, symbols.code('keyword', 'if'))
+        self.assertEqual(0, symbols.code('string', 'double'))
+        self.assertEqual(('keyword', 'if'), symbols.symbol(1))
+        self.assertEqual(2, len(symbols))
+
+    def testSymbolTableTracksCodesOfGroupsAndTypes(self):
+        symbols = tartak.tokens.SymbolTable()
+        integers = symbols.group('integer')
+        dec, hexadecimal = symbols.code('integer', 'dec'), symbols.code('integer', 'hex')
+        self.assertEqual({dec, hexadecimal}, integers)
+        self.assertEqual({dec}, symbols.type('dec'))
+        self.assertEqual(set(), symbols.group('string'))
+
+    def testLexerTokensCarrySymbolCodes(self):
+        lxr = getDefaultLexer()
+        self.assertEqual(len(lxr.rules()), len(lxr.symbols()))
+        for compact in (False, True):
+            lxr = getDefaultLexer('if x == "y"').setFlag('compact', compact).tokenize()
+            for i, token in enumerate(lxr.tokens()):
+                self.assertEqual((token.group(), token.type()), lxr.symbols().symbol(token.code()))
+                self.assertEqual(token.code(), lxr.tokens().code(i))
+        self.assertIsNone(tartak.tokens.Token(0, 0, 'x', 'name', 'name').code())
+
+
+class TokenSerializationTests(unittest.TestCase):
+    def testWritingTokensAsJSONList(self):
+        import io
+        string = 'if "foo" == 42:\n    pass\n'
+        tokens = getDefaultLexer(string).tokenize().tokens()
+        ofstream = io.StringIO()
+        tartak.tokens.TokenWriter(ofstream).extend(tokens).close()
+        self.assertEqual(json.dumps(tokens.dumps()), ofstream.getvalue())
+
+    def testWritingNoTokensAsJSONList(self):
+        import io
+        ofstream = io.StringIO()
+        tartak.tokens.TokenWriter(ofstream).close()
+        self.assertEqual([], json.loads(ofstream.getvalue()))
+
+    def testReadingWrittenTokens(self):
+        import io
+        string = 'if "foo\\"bar" == 42:\n    pass\n' * 8
+        tokens = getDefaultLexer(string).tokenize().tokens()
+        for format in ('json', 'ndjson'):
+            ofstream = io.StringIO()
+            tartak.tokens.TokenWriter(ofstream, format).extend(tokens).close()
+            read = tartak.tokens.TokenReader(io.StringIO(ofstream.getvalue()), size=3)
+            self.assertEqual([t.dumps() for t in tokens], [t.dumps() for t in read])
+
+    def testDumpingAndLoadingBinaryTokens(self):
+        import io
+        string = 'if "zażółć\\"gęślą" == 42:\n    pass\n' * 8
+        tokens = getDefaultLexer(string).tokenize().tokens()
+        ofstream = io.BytesIO()
+        tokens.dump_binary(ofstream, source=string)
+        self.assertEqual(b'TRTK', ofstream.getvalue()[:4])
+        loaded, source = tartak.tokens.TokenStream.load_binary(io.BytesIO(ofstream.getvalue()))
+        self.assertEqual([t.dumps() for t in tokens], [t.dumps() for t in loaded])
+        self.assertEqual(string, source)
+
+    def testLoadingBinaryTokensWithoutSource(self):
+        import io
+        ofstream = io.BytesIO()
+        getDefaultLexer('if 42').tokenize().tokens().point(1).dump_binary(ofstream)
+        loaded, source = tartak.tokens.TokenStream.load_binary(io.BytesIO(ofstream.getvalue()))
+        self.assertEqual(['42'], [t.value() for t in loaded])
+        self.assertIsNone(source)
+
+    def testLoadingInvalidBinaryTokens(self):
+        import io
+        self.assertRaises(tartak.errors.TokenFormatError, tartak.tokens.TokenStream.load_binary, io.BytesIO(b'[{"line": 0}]'))
+        self.assertRaises(tartak.errors.TokenFormatError, tartak.tokens.TokenStream.load_binary, io.BytesIO(b'TRTK\x01\x00'))
+
+    def testLoadingDumpedToken(self):
+        token = getDefaultLexer('"foo"').tokenize().tokens().get(0)
+        self.assertEqual(token.dumps(), tartak.tokens.Token(0, 0, '', '').loads(token.dumps()).dumps())
+
 
 class ParserSimpleMatchingTests(unittest.TestCase):
     def testMatchingByStringLiteral(self):
@@ -1276,6 +1742,174 @@ class ParserGroupMatchingTests(unittest.TestCase):
             self.assertEqual(count, 10)
 
 
+class ParserPackratTests(unittest.TestCase):
+    def getBacktrackingRule(self, depth):
+        """Each level of the rule tries the level below it twice.
+        """
+        rule = [{'type': 'identifier', 'quantifier': None, 'value': 'name'}]
+        for i in range(depth):
+            inner = rule
+            rule = [
+                {
+                    'type': 'alternative',
+                    'quantifier': None,
+                    'value': [
+                        {'type': 'group', 'quantifier': None, 'value': [{'type': 'group', 'quantifier': None, 'value': inner}, {'type': 'string', 'quantifier': None, 'value': '='}]},
+                        {'type': 'group', 'quantifier': None, 'value': [{'type': 'group', 'quantifier': None, 'value': inner}, {'type': 'string', 'quantifier': None, 'value': ';'}]},
+                    ],
+                },
+            ]
+        return rule
+
+    def testMemoizedMatchingGivesSameResults(self):
+        for depth in range(1, 6):
+            tokens = getDefaultLexer().feed('x' + ';'*depth).tokenize().tokens()
+            rule = self.getBacktrackingRule(depth)
+            self.assertEqual(tartak.parser.Parser.matchrule(rule, tokens), tartak.parser.Parser.matchrule(rule, tokens, memo=tartak.parser.Memo()))
+            self.assertEqual((True, depth+1), tartak.parser.Parser.matchrule(rule, tokens, memo=tartak.parser.Memo()))
+
+    def testMemoizedMatchingIsLinear(self):
+        depth = 40
+        tokens = getDefaultLexer().feed('x' + ';'*depth).tokenize().tokens()
+        memo = tartak.parser.Memo()
+        self.assertEqual((True, depth+1), tartak.parser.Parser.matchrule(self.getBacktrackingRule(depth), tokens, memo=memo))
+        self.assertTrue(len(memo) < 10*depth)
+
+    def testMemoCanBeBounded(self):
+        depth = 8
+        tokens = getDefaultLexer().feed('x' + ';'*depth).tokenize().tokens()
+        memo = tartak.parser.Memo(limit=5)
+        self.assertEqual((True, depth+1), tartak.parser.Parser.matchrule(self.getBacktrackingRule(depth), tokens, memo=memo))
+        self.assertEqual(5, len(memo))
+
+    def testReparsingGivesSameResultsAsParsing(self):
+        statement = [{'type': 'group', 'quantifier': '*', 'value': [
+            {'type': 'identifier', 'quantifier': None, 'value': 'name'},
+            {'type': 'string', 'quantifier': None, 'value': '='},
+            {'type': 'alternative', 'quantifier': None, 'value': [
+                {'type': 'identifier', 'quantifier': None, 'value': 'integer:'},
+                {'type': 'identifier', 'quantifier': None, 'value': 'name'},
+            ]},
+            {'type': 'string', 'quantifier': None, 'value': ';'},
+        ]}]
+        class CountingMemo(tartak.parser.Memo):
+            computed = 0
+            def put(self, key, result, outer=0):
+                self.computed += 1
+                return super().put(key, result, outer)
+        lxr = getDefaultLexer(''.join('x{0} = {0};\n'.format(i) for i in range(20))).tokenize()
+        memo = CountingMemo()
+        self.assertEqual((True, 80), tartak.parser.Parser.matchrule(statement, lxr.tokens(), memo))
+        for start, end, text in [(16, 17, 'y'), (24, 24, 'z = 0;\n'), (0, 8, '')]:
+            lxr.relex(start, end, text)
+            expected = tartak.parser.Parser.matchrule(statement, lxr.tokens(), tartak.parser.Memo())
+            memo.computed = 0
+            self.assertEqual(expected, tartak.parser.Parser.reparse(statement, lxr.tokens(), memo, *lxr.edited()))
+            self.assertTrue(memo.computed < 10)
+        self.assertEqual((True, 80), tartak.parser.Parser.matchrule(statement, lxr.tokens()))
+
+    def testReparsingLooksUpResultsAroundTheEditOnly(self):
+        statement = [{'type': 'group', 'quantifier': '*', 'value': [
+            {'type': 'identifier', 'quantifier': None, 'value': 'name'},
+            {'type': 'string', 'quantifier': None, 'value': '='},
+            {'type': 'identifier', 'quantifier': None, 'value': 'integer:'},
+            {'type': 'string', 'quantifier': None, 'value': ';'},
+        ]}]
+        class CountingMemo(tartak.parser.Memo):
+            looked = 0
+            def get(self, key):
+                self.looked += 1
+                return super().get(key)
+            def put(self, key, result, outer=0):
+                self.looked += 1
+                return super().put(key, result, outer)
+        def lookups(rule, count, inserted):
+            lines = ['x{0} = {0};\n'.format(i) for i in range(count)]
+            lxr = getDefaultLexer(''.join(lines)).tokenize()
+            memo = CountingMemo()
+            tartak.parser.Parser.matchrule(rule, lxr.tokens(), memo)
+            offset = len(''.join(lines[:count//2]))
+            lxr.relex(offset, offset, 'y = 0;\n' * inserted)
+            memo.looked = 0
+            self.assertEqual((True, 4*(count+inserted)), tartak.parser.Parser.reparse(rule, lxr.tokens(), memo, *lxr.edited()))
+            return memo.looked
+        for rule in (statement, tartak.parser.Parser.compile(statement)):
+            self.assertTrue(lookups(rule, 1600, 1) < lookups(rule, 50, 1) + 5)
+            self.assertTrue(lookups(rule, 1600, 40) > lookups(rule, 1600, 1) + 40)
+
+    def testReparsingDropsResultsThatExaminedEditedTokens(self):
+        rule = [{'type': 'identifier', 'quantifier': '*', 'value': 'name'}, {'type': 'string', 'quantifier': None, 'value': ';'}]
+        lxr = getDefaultLexer('a b c ;').tokenize()
+        memo = tartak.parser.Memo()
+        self.assertEqual((True, 4), tartak.parser.Parser.matchrule(rule, lxr.tokens(), memo))
+        lxr.relex(6, 7, '= ;')
+        self.assertEqual((0, 4, 5), lxr.edited())
+        self.assertEqual((False, 4), tartak.parser.Parser.reparse(rule, lxr.tokens(), memo, *lxr.edited()))
+        self.assertEqual((False, 4), tartak.parser.Parser.matchrule(rule, lxr.tokens()))
+
+
+class ParserCompilerTests(unittest.TestCase):
+    def testCompiledRulesGiveSameResults(self):
+        rules = [
+            [{'type': 'identifier', 'quantifier': None, 'value': 'keyword:if'}, {'type': 'identifier', 'quantifier': '+', 'value': 'name'}],
+            [{'type': 'identifier', 'quantifier': '*', 'value': ':name'}, {'type': 'string', 'quantifier': '?', 'value': '='}, {'type': 'identifier', 'quantifier': None, 'value': 'integer:'}],
+            [{'type': 'alternative', 'quantifier': '+', 'value': [{'type': 'identifier', 'quantifier': None, 'value': 'integer:'}, {'type': 'string', 'quantifier': None, 'value': ';'}]}],
+            [{'type': 'group', 'quantifier': '?', 'value': [{'type': 'identifier', 'quantifier': None, 'value': ':'}, {'type': 'string', 'quantifier': None, 'value': '='}]}, {'type': 'identifier', 'quantifier': None, 'value': 'dec'}],
+            ParserPackratTests().getBacktrackingRule(3),
+        ]
+        for string in ['if x y', 'x y = 42', '42 ; 0x2a', 'x = 0', 'x;;;', '']:
+            for compact in (False, True):
+                lxr = getDefaultLexer(string).setFlag('compact', compact).tokenize()
+                tokens = lxr.tokens()
+                for rule in rules:
+                    try: expected = tartak.parser.Parser.matchrule(rule, tokens)
+                    except IndexError: continue
+                    compiled = tartak.parser.Parser.compile(rule)
+                    self.assertEqual(expected, tartak.parser.Parser.matchrule(compiled, tokens))
+                    self.assertEqual(expected, compiled.match(tokens, 0, tartak.parser.Memo()))
+                    self.assertEqual(expected, tartak.parser.Parser.compile(rule, lxr.symbols()).match(tokens))
+
+    def testCompiledRulesGiveSameResultsForTokensTheyCannotBeginWith(self):
+        optional = {'type': 'string', 'quantifier': '?', 'value': 'if'}
+        name = {'type': 'identifier', 'quantifier': None, 'value': 'name'}
+        rules = [
+            [optional, name],
+            [{'type': 'alternative', 'quantifier': None, 'value': [name, {'type': 'group', 'quantifier': '?', 'value': [name]}]}],
+            [{'type': 'group', 'quantifier': '?', 'value': [optional, name]}, {'type': 'string', 'quantifier': None, 'value': '='}],
+            [{'type': 'group', 'quantifier': '+', 'value': [optional, name]}, {'type': 'identifier', 'quantifier': '*', 'value': 'integer:'}],
+        ]
+        expected = {
+            'if x = 1': [(True, 2), (True, 0), (True, 3), (False, 2)],
+            'x = 1': [(True, 1), (True, 1), (True, 2), (False, 1)],
+            '= x': [(False, 1), (True, 0), (True, 1), (False, 0)],
+            'if = x': [(False, 2), (True, 0), (False, 1), (False, 0)],
+            '42 if x': [(False, 1), (True, 0), (False, 1), (False, 0)],
+        }
+        for string, results in expected.items():
+            lxr = getDefaultLexer(string).tokenize()
+            tokens = lxr.tokens()
+            self.assertEqual(results, [tartak.parser.Parser.matchrule(rule, tokens) for rule in rules])
+            for rule, result in zip(rules, results):
+                self.assertEqual(result, tartak.parser.Parser.compile(rule).match(tokens))
+                self.assertEqual(result, tartak.parser.Parser.compile(rule).match(tokens, 0, tartak.parser.Memo()))
+                self.assertEqual(result, tartak.parser.Parser.compile(rule, lxr.symbols()).match(tokens))
+
+    def testCompiledAlternativesAreNotTriedWhenTheyCannotBegin(self):
+        statements = [{'type': 'alternative', 'quantifier': '*', 'value': [
+            {'type': 'group', 'quantifier': None, 'value': [{'type': 'string', 'quantifier': None, 'value': keyword}, {'type': 'identifier', 'quantifier': None, 'value': 'name'}]}
+            for keyword in ['if', 'pass', 'x', 'y', 'z']
+        ]}]
+        tokens = getDefaultLexer('z a y b x c pass d if e').tokenize().tokens()
+        memo, compiled_memo = tartak.parser.Memo(), tartak.parser.Memo()
+        self.assertEqual((True, 10), tartak.parser.Parser.matchrule(statements, tokens, memo))
+        self.assertEqual((True, 10), tartak.parser.Parser.matchrule(tartak.parser.Parser.compile(statements), tokens, compiled_memo))
+        self.assertLess(len(compiled_memo), len(memo))
+        self.assertEqual((True, 10), tartak.parser.Parser.matchrule(tartak.parser.Parser.compile(statements), tokens))
+
+    def testCompilingRejectsInvalidQuantifiers(self):
+        self.assertRaises(ValueError, tartak.parser.Parser.compile, [{'type': 'string', 'quantifier': '!', 'value': 'if'}])
+
+
 class ParserImporterTests(unittest.TestCase):
     @unittest.skip('TODO')
     def testImportingRule(self):
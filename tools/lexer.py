@@ -4,32 +4,56 @@
 
 SYNOPSIS:
     python3 tools/lexer.py --help
-    python3 tools/lexer.py [--errors <mode>] <rules> <file> [<output>]
+    python3 tools/lexer.py [--errors <mode>] [--format <format>] [--mmap] [--encoding <encoding>] [--jobs <n>] <rules> <file> [<output>]
     python3 tools/lexer.py (--check-syntax | -S) <rules> <file> [<output>]
 
 
 OPTIONS:
     -e, --errors <mode>     - tells how to handle errors (throw, save, drop)
+    -f, --format <format>   - output format (json, ndjson, binary)
     -S, --check-syntax      - just check if file can be lexed
+    --mmap                  - lex input directly from memory-mapped file
+    --encoding <encoding>   - encoding of input file (default: utf-8)
+    -j, --jobs <n>          - lex input in <n> parallel processes
+    --no-cache              - do not use cache of imported rule files
     -h, --help              - display this message
 
 
 USAGE:
     The lexer frontend takes a <file> and tokenizes it according to rules described by
     <rules>.
-    The result of the lexing process is a JSON encoded list of tokens.
+    The result of the lexing process is a JSON encoded list of tokens, or with "--format ndjson"
+    a sequence of JSON encoded tokens, one per line.
+    With "--format binary" tokens are written in Tartak's compact binary format (see
+    tartak.tokens.TokenStream.dump_binary()); binary output is written after the whole input is lexed.
 
     The lexing stops the moment an end-of-file is reached, i.e. input string is exhausted, or
     the lexer encounters a sequence it cannot recognize.
     In the latter situation lexer report the error and tells where to look for it giving its full
     location (line and character position).
 
+    Lexers imported from rule files are cached (in directory given by TARTAK_CACHE_DIR environment
+    variable, or ~/.cache/tartak) so that following runs with the same rules need not import them again.
+
     The output is by default written to a file called "a.tokens".
     This behaviour can be overriden by specifying the <output> operand.
     If it is a path, lexer will check if it can create the output file by writing empty string to it;
     in case of error during lexing the file is removed.
     If the file cannot be created - lexer aborts.
     If the <output> operand is a single hyphen character "-" the output is written to standard output.
+    Tokens are written as soon as they are generated, so memory use does not grow with the size of input.
+
+    With --mmap option the input file is memory-mapped and decoded piece by piece instead of being
+    read through a text file object.
+    The encoding of input file can be given with --encoding option.
+
+    With "--jobs <n>" option the input file is read whole, split into chunks at line boundaries and
+    lexed by <n> processes (see tartak.parallel.ParallelLexer); the tokens are the same as if the file
+    was lexed by a single process, but they are written only after the whole input is lexed.
+
+    With "--errors save" or "--errors drop" lexer does not stop on unrecognized sequences but
+    saves them as tartak:invalid tokens or drops them; the number and total length of such sequences
+    is reported on standard error output when lexing finishes.
 
 
 BUGS:
@@ -39,6 +63,7 @@ BUGS:
 
 import glob
 import json
+import mmap
 import os
 import sys
 
@@ -112,11 +137,24 @@ LEXER_RULES, INPUT, OUTPUT = operands
 JUST_CHECK_SYNTAX = ('--syntax-check' in ui)
 
 ERRORS = (ui.get('--errors') if '--errors' in ui else 'throw')
+USE_MMAP = ('--mmap' in ui)
+ENCODING = (ui.get('--encoding') if '--encoding' in ui else 'utf-8')
+FORMAT = (ui.get('--format') if '--format' in ui else 'json')
+NO_CACHE = ('--no-cache' in ui)
+JOBS = (int(ui.get('--jobs')) if '--jobs' in ui else 1)
 
 if ERRORS not in ['throw', 'save', 'drop']:
     print('fatal: unknown error handling mode: {0}'.format(ERRORS))
     exit(1)
 
+if FORMAT not in ['json', 'ndjson', 'binary']:
+    print('fatal: unknown output format: {0}'.format(FORMAT))
+    exit(1)
+
+if JOBS < 1:
+    print('fatal: invalid number of jobs: {0}'.format(JOBS))
+    exit(1)
+
 if not os.path.isfile(INPUT):
     print('fatal: {0} does not point to a file'.format(repr(INPUT)))
     exit(1)
@@ -277,7 +315,8 @@ else:
         exit(3)
     with open(LEXER_RULES, 'r') as ifstream:
         try:
-            lexer, msg = tartak.lexer.Importer().feed(ifstream.read()).parse().lexer(), None
+            rules = ifstream.read()
+            lexer, msg = (tartak.lexer.Importer().feed(rules).parse().lexer() if NO_CACHE else tartak.cache.LexerCache().lexer(rules)), None
         except tartak.errors.TartakSyntaxError as e:
             lexer, msg = None, str(e)
         finally:
@@ -286,17 +325,40 @@ else:
                 print(msg)
                 exit(2)
 
+
 try:
-    with open(INPUT, 'r') as ifstream: string = ifstream.read()
-    lexer.feed(string).tokenize(errors=ERRORS)
-    if not JUST_CHECK_SYNTAX:
-        out = json.dumps(lexer.tokens().dumps())
-        if OUTPUT == '-':
-            print(out)
+    with (open(INPUT, 'rb') if USE_MMAP else open(INPUT, 'r', encoding=ENCODING)) as ifstream:
+        source = ifstream
+        if USE_MMAP and os.path.getsize(INPUT): source = mmap.mmap(ifstream.fileno(), 0, access=mmap.ACCESS_READ)
+        if JOBS > 1:
+            string = source.read()
+            if isinstance(string, bytes): string = string.decode(ENCODING)
+            tokens = tartak.parallel.ParallelLexer(lexer, JOBS).feed(string).tokenize(errors=ERRORS).tokens()
         else:
-            with open(OUTPUT, 'w') as ofstream: ofstream.write(out)
+            tokens = lexer.iter_tokens(source, errors=ERRORS, encoding=ENCODING)
+        if JUST_CHECK_SYNTAX:
+            for token in tokens: pass
+        elif FORMAT == 'binary':
+            tokens = tartak.tokens.TokenStream(tokens)
+            if OUTPUT == '-':
+                tokens.dump_binary(sys.stdout.buffer)
+            else:
+                with open(OUTPUT, 'wb') as ofstream: tokens.dump_binary(ofstream)
+        elif OUTPUT == '-':
+            tartak.tokens.TokenWriter(sys.stdout, FORMAT).extend(tokens).close()
+            if FORMAT == 'json': print()
+        else:
+            with open(OUTPUT, 'w') as ofstream: tartak.tokens.TokenWriter(ofstream, FORMAT).extend(tokens).close()
+        if source is not ifstream: source.close()
+    invalid, size = lexer.invalid()
+    if invalid:
+        print('note: {0} {1} unlexable sequence(s), {2} character(s) in total'.format(('saved' if ERRORS == 'save' else 'dropped'), invalid, size), file=sys.stderr)
 except tartak.errors.LexerError as e:
+    if OUTPUT != '-' and os.path.isfile(OUTPUT): os.remove(OUTPUT)
     print('fail: {0}'.format(e))
     exit(4)
+except (LookupError, UnicodeDecodeError) as e:
+    print('fatal: cannot decode input: {0}'.format(e))
+    exit(4)
 finally:
     pass
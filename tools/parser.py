@@ -1,9 +1,11 @@
 #!/usr/bin/python3
 
 """Frontend to Tartak parser.
+
+Tokens are loaded from JSON (list or one token per line) or binary token files written by the lexer frontend;
+the format is detected automatically.
 """
 
-import json
 import os
 import sys
 
@@ -36,13 +38,17 @@ if not os.path.isfile(INPUT):
     print('fatal: there is not such file: "{0}"'.format(INPUT))
     exit(2)
 
-ifstream = open(INPUT, 'r')
-string = ifstream.read()
-ifstream.close()
-
-lexer = tartak.lexer.Lexer().loads(json.loads(string))
-print('loaded lexer state\n------------------')
-print(''.join([i.value() for i in lexer.tokens(raw=True)]))
+with open(INPUT, 'rb') as ifstream: binary = (ifstream.read(4) == b'TRTK')
 
-parser = tartak.parser.NewParser(lexer)
+try:
+    if binary:
+        with open(INPUT, 'rb') as ifstream: tokens, source = tartak.tokens.TokenStream.load_binary(ifstream)
+    else:
+        with open(INPUT, 'r') as ifstream: tokens = tartak.tokens.TokenStream(tartak.tokens.TokenReader(ifstream))
+except (tartak.errors.TokenFormatError, ValueError) as e:
+    print('fatal: cannot load tokens from "{0}": {1}'.format(INPUT, e))
+    exit(3)
+print('loaded {0} tokens\n------------------'.format(len(tokens)))
+
+parser = tartak.parser.NewParser(tokens)
 parser.append(name='element', pattern=[{'type': 'string', 'value': ['['], 'mod': ''}])